@@ -3,17 +3,235 @@
 ################################################################################
 
 ### IMPORT NECESSARY PACKAGES ###
+import ast
 import csv
+import json
+import shutil
 import sys
 import re
 import os
 from zipfile import ZipFile
+from concurrent.futures import ProcessPoolExecutor
+from itertools import groupby, repeat
 import gzip
 import geopandas as gp
 import numpy as np
 import pandas as pd
 from geopy.distance import geodesic
 
+POI_COLUMNS = ['safegraph_place_id','parent_safegraph_place_id','location_name',
+               'safegraph_brand_ids','brands','top_category','sub_category',
+               'naics_code','latitude','longitude','street_address','city','region',
+               'postal_code','iso_country_code','phone_number','open_hours','category_tags' ]
+CORE_POI_PART_PATTERN = re.compile(r'core_poi-part(\d+)\.csv(\.gz)?')
+# column names of the fields read from weekly patterns and home panel summary files, with the accepted header names
+# of each field in order of preference (SafeGraph / Advan schema versions)
+PATTERNS_SCHEMA = {'poi_id': ['safegraph_place_id', 'placekey'],
+                   'location_name': ['location_name'],
+                   'date_range_start': ['date_range_start'],
+                   'date_range_end': ['date_range_end'],
+                   'raw_visit_counts': ['raw_visit_counts'],
+                   'raw_visitor_counts': ['raw_visitor_counts'],
+                   'poi_cbg': ['poi_cbg'],
+                   'visitor_home_cbgs': ['visitor_home_cbgs']}
+HOME_PANEL_SCHEMA = {'date_range_start': ['date_range_start'],
+                     'date_range_end': ['date_range_end'],
+                     'census_block_group': ['census_block_group'],
+                     'number_devices_residing': ['number_devices_residing']}
+CHUNK_PROBE_ROWS = 1000         # rows read to estimate the memory footprint of a core_poi row
+CHUNK_MEMORY_OVERHEAD = 3       # a chunk is held alongside its parse buffers and filtered copies
+EARTH_MEAN_RADIUS_KM = 6371.0088        # IUGG mean radius, used by the haversine distance
+WGS84_SEMI_MAJOR_AXIS_KM = 6378.137
+WGS84_FLATTENING = 1 / 298.257223563
+DISTANCE_MODES = ('haversine', 'ellipsoidal', 'geodesic')
+FLOW_OUTPUTS = ('kepler', 'full', 'network_analysis')
+# flow resolutions: GEOID digits of a unit, and the shapefile column identifying it in the flow outputs (None: its GEOID)
+FLOW_LEVELS = {'CBG': (12, None), 'CT': (11, 'TRACTCE')}
+EXTRACT_BASED_ON_LEVELS = {'CBGs': ['CBG'], 'Census Tracts': ['CT'], 'both': ['CBG', 'CT']}
+FLOW_OUTPUT_FORMATS = {'csv': '.csv', 'csv.gz': '.csv.gz', 'parquet': '.parquet'}
+FLOW_WRITE_CHUNK_ROWS = 100000  # rows of a flow table written at a time
+
+def parse_home_cbgs(home_cbgs):
+    """
+    This function parses a visitor_home_cbgs field (a JSON object of home CBG -> visitor count) into a dictionary with a JSON
+    decoder. Fields written as Python dictionaries by earlier versions of county_weekly_visits are read with ast.literal_eval;
+    nothing in the field is ever executed. An empty or missing field gives an empty dictionary.
+
+    home_cbgs: str
+            The visitor_home_cbgs field. Eg. '{"482011000001":4,"482015437001":12}'
+    """
+    if not isinstance(home_cbgs, str) or not home_cbgs.strip():
+        return {}
+    try:
+        return json.loads(home_cbgs)
+    except ValueError:
+        return ast.literal_eval(home_cbgs.strip())
+
+
+def parse_home_cbgs_arrays(home_cbgs_column, cbg_prefixes=None):
+    """
+    This function parses a column of visitor_home_cbgs fields into flat (row, cbg, count) arrays without building a
+    dictionary per field: row is the position of the field in home_cbgs_column and (cbg, count) one of its entries.
+
+    home_cbgs_column: iterable
+            The visitor_home_cbgs fields. Eg. a pandas series or a list of strings.
+
+    cbg_prefixes: tuple
+            Optional tuple of GEOID prefixes (Eg. county FIPS codes). If given, only the entries whose home CBG starts with
+            one of them are kept, so the arrays grow with the selected origin-destination pairs only.
+
+    Returns three numpy arrays (row: int64, cbg: object, count: int64) of equal length.
+    """
+    rows, cbgs, counts = [], [], []
+    decoder = json.JSONDecoder(object_pairs_hook=list)
+    for row, home_cbgs in enumerate(home_cbgs_column):
+        if not isinstance(home_cbgs, str) or not home_cbgs.strip():
+            continue
+        try:
+            pairs = decoder.decode(home_cbgs)
+        except ValueError:
+            pairs = list(ast.literal_eval(home_cbgs.strip()).items())
+        if cbg_prefixes is not None:
+            pairs = [(cbg, count) for cbg, count in pairs if cbg.startswith(cbg_prefixes)]
+        rows.extend([row] * len(pairs))
+        for cbg, count in pairs:
+            cbgs.append(cbg)
+            counts.append(count)
+    return (np.array(rows, dtype='int64'), np.array(cbgs, dtype=object), np.array(counts, dtype='int64'))
+
+
+def distance_km(lat1, lon1, lat2, lon2, mode='ellipsoidal'):
+    """
+    This function computes the distances in km between two arrays of points (in degrees), element by element, over the
+    whole arrays at once.
+
+    lat1, lon1, lat2, lon2: array-like
+            Latitudes and longitudes of the origins and destinations. Eg. numpy arrays or pandas series of equal length.
+
+    mode: str
+            'haversine': great-circle distance on a sphere of the mean Earth radius (error up to about 0.5% vs geodesic).
+            'ellipsoidal': Lambert's formula on the WGS84 ellipsoid (error vs geodesic of about 1 m up to 1,000 km and about
+            12 m up to 10,000 km; well under a meter at county scale). This is the default value.
+            'geodesic': geopy's exact WGS84 geodesic, computed point by point (slow, for reference).
+
+    Returns a numpy array of float64 distances in km.
+    """
+    if mode not in DISTANCE_MODES:
+        raise ValueError(f"mode must be one of {DISTANCE_MODES}")
+    lat1, lon1, lat2, lon2 = (np.asarray(coords, dtype='float64') for coords in (lat1, lon1, lat2, lon2))
+    if mode == 'geodesic':
+        return np.array([geodesic((lat_a, lon_a), (lat_b, lon_b)).km
+                         for lat_a, lon_a, lat_b, lon_b in zip(lat1, lon1, lat2, lon2)], dtype='float64')
+
+    phi1, phi2 = np.radians(lat1), np.radians(lat2)
+    if mode == 'ellipsoidal':
+        # reduced latitudes on the ellipsoid
+        phi1 = np.arctan((1 - WGS84_FLATTENING) * np.tan(phi1))
+        phi2 = np.arctan((1 - WGS84_FLATTENING) * np.tan(phi2))
+    delta_lambda = np.radians(lon2 - lon1)
+    hav = np.sin((phi2 - phi1) / 2) ** 2 + np.cos(phi1) * np.cos(phi2) * np.sin(delta_lambda / 2) ** 2
+    sigma = 2 * np.arcsin(np.sqrt(np.clip(hav, 0, 1)))
+    if mode == 'haversine':
+        return EARTH_MEAN_RADIUS_KM * sigma
+
+    P = (phi1 + phi2) / 2
+    Q = (phi2 - phi1) / 2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        X = (sigma - np.sin(sigma)) * np.sin(P) ** 2 * np.cos(Q) ** 2 / np.cos(sigma / 2) ** 2
+        Y = (sigma + np.sin(sigma)) * np.cos(P) ** 2 * np.sin(Q) ** 2 / np.sin(sigma / 2) ** 2
+        distances = WGS84_SEMI_MAJOR_AXIS_KM * (sigma - WGS84_FLATTENING / 2 * (X + Y))
+    # coincident points
+    return np.where(sigma == 0, 0.0, distances)
+
+
+class ODAccumulator:
+    """
+    This class accumulates origin-destination visitor counts, i.e. visitor_home_cbgs contributions (home CBG -> count) per
+    destination key, in place. Home CBG GEOIDs are interned to integer ids once and each destination key holds its counts
+    sparsely ({cbg id: count}).
+    """
+    def __init__(self):
+        self.cbg_ids = {}
+        self.cbgs = []
+        self.flows = {}
+
+    def __len__(self):
+        return len(self.flows)
+
+    def __contains__(self, key):
+        return key in self.flows
+
+    def keys(self):
+        return self.flows.keys()
+
+    def intern(self, cbg):
+        """
+        This function returns the integer id of a home CBG GEOID, interning it on first use.
+        """
+        cbg_id = self.cbg_ids.get(cbg)
+        if cbg_id is None:
+            cbg_id = self.cbg_ids[cbg] = len(self.cbgs)
+            self.cbgs.append(cbg)
+        return cbg_id
+
+    def add(self, key, home_cbgs):
+        """
+        This function adds the (home CBG, count) pairs of a dictionary (Eg. from parse_home_cbgs) to the counts of key.
+        """
+        self.add_pairs(key, home_cbgs.items())
+
+    def add_pairs(self, key, pairs):
+        """
+        This function adds an iterable of (home CBG, count) pairs to the counts of key.
+        """
+        intern = self.intern
+        flows = self.flows.get(key)
+        if flows is None:
+            flows = self.flows[key] = {}
+        for cbg, count in pairs:
+            cbg_id = intern(cbg)
+            flows[cbg_id] = flows.get(cbg_id, 0) + count
+
+    def merge(self, other):
+        """
+        This function adds the counts of another ODAccumulator into this one in place, key by key in the order of other.
+        """
+        for key in other.keys():
+            self.add_pairs(key, other.get(key).items())
+
+    def get(self, key):
+        """
+        This function returns the counts of key as a dictionary of home CBG -> count, in the order the CBGs were first added.
+        """
+        flows = self.flows.get(key)
+        if flows is None:
+            return {}
+        return {self.cbgs[cbg_id]: count for cbg_id, count in flows.items()}
+
+    def to_frame(self, keys=None):
+        """
+        This function exports the counts in long format: one row per (destination key, home CBG) pair with its count, key by
+        key and in the order of get within a key.
+
+        keys: iterable
+                The destination keys to export. Defaults to all keys, in the order they were first added.
+
+        Returns a pandas dataframe with the columns '_row' (the position of the destination key in keys), 'GEOID' (home CBG)
+        and 'Visitor_Count'.
+        """
+        key_rows, cbg_ids, counts = [], [], []
+        for key_row, key in enumerate(self.flows.keys() if keys is None else keys):
+            flows = self.flows.get(key)
+            if flows is None:
+                continue
+            key_rows.extend([key_row] * len(flows))
+            cbg_ids.extend(flows.keys())
+            counts.extend(flows.values())
+        return pd.DataFrame({'_row': np.array(key_rows, dtype='int64'),
+                             'GEOID': np.array(self.cbgs, dtype=object)[np.array(cbg_ids, dtype='int64')],
+                             'Visitor_Count': np.array(counts, dtype='int64')})
+
+
 class Extract:
     def __init__(self):
         maxInt = sys.maxsize
@@ -25,6 +243,62 @@ class Extract:
                 maxInt = int(maxInt / 10)
 
 
+    def get_naics_strings(self, df):
+        """
+        This function normalizes the naics_code column of a dataframe to a column of digit strings (Eg. 611110.0 -> '611110'),
+        so that NAICS codes of varying lengths can be matched as string prefixes. Missing or non-numeric codes are NaN.
+
+        df: pandas dataframe
+                A dataframe of POIs containing a 'naics_code' column.
+
+        """
+        naics = pd.to_numeric(df['naics_code'], errors='coerce')
+        valid = naics.notna().values
+        naics_str = np.full(len(naics), np.nan, dtype=object)
+        naics_str[valid] = naics.values[valid].astype('int64').astype(str)
+        return pd.Series(naics_str, index=df.index, dtype=object)
+
+
+    def get_naics_codes(self, df, naics_codes, naics_str=None, as_masks=False):
+        """
+        This function assigns every row of a dataframe to the first of the requested NAICS codes that prefixes its naics_code,
+        in a single vectorized pass over the dataframe for any number of codes of mixed lengths.
+
+        df: pandas dataframe
+                A dataframe of POIs containing a 'naics_code' column.
+
+        naics_codes: list
+                A string list of digits of the North American Industry Classification System (NAICS) codes. Eg. ['611110', '61', '722511']
+                The order of the list decides the code assigned to a row matched by more than one code.
+
+        naics_str: pandas series
+                The normalized naics_code column returned by get_naics_strings. Computed from df if not given.
+
+        as_masks: Boolean
+                If False (default) return a series holding the assigned NAICS code of each row (NaN where no code matches).
+                If True return a dictionary of boolean masks keyed by NAICS code instead.
+
+        """
+        if naics_str is None:
+            naics_str = self.get_naics_strings(df)
+        naics_str = naics_str.values
+        unassigned = pd.notna(naics_str)
+        assigned = np.full(len(naics_str), np.nan, dtype=object)
+        naics_masks = {}
+        prefixes = {}
+        for naics_code in naics_codes:
+            n = len(naics_code)
+            if n not in prefixes:
+                prefixes[n] = pd.Series(naics_str, dtype=object).str[:n].values
+            hit = unassigned & (prefixes[n] == naics_code)
+            assigned[hit] = naics_code
+            unassigned &= ~hit
+            naics_masks[naics_code] = hit
+        if as_masks:
+            return naics_masks
+        return pd.Series(assigned, index=df.index, dtype=object)
+
+
     def get_naics_mask(self, df, naics_code):
         """
         This function creates a mask to filter NAICS codes of varying lengths in a dataframe.
@@ -34,12 +308,114 @@ class Extract:
                 the business to extract POIs. Eg. For elmentary and secondary schools: ['611110'], For education: ['61']
         
         """
-        n = len(naics_code)
-        naics_mask = [(not pd.isna(ncode)) and (str(int(ncode))[:n] == naics_code) for ncode in list(df['naics_code'])]
-        return naics_mask
+        return self.get_naics_codes(df, [naics_code], as_masks=True)[naics_code]
     
     
-    def POIs(self,naics_codes, region_filter, base_filepath, core_poi_filenames, results_filepath):
+    def core_poi_parts(self, base_filepath, core_poi_filename):
+        """
+        This function discovers the core_poi parts of a release with a single listing of its directory or zip archive,
+        however many parts there are.
+
+        base_filepath: path
+                    A path of type string to your base directory containing all the core POIs
+
+        core_poi_filename: str
+                    A core_poi release in your base_filepath. Either a directory prefix holding core_poi-partN.csv(.gz) files
+                    (Eg. 'core_poi/2021/01/') or the name of a zip archive of core_poi-partN.csv.gz members without the '.zip' extension.
+
+        Returns a list of (path, member) tuples in part order, where member is the name of the csv.gz member when path is a
+        zip archive and None otherwise. Loose uncompressed parts are used first (a .csv.gz copy fills in for a missing .csv part),
+        then the zip archive, then loose .csv.gz parts.
+        """
+        release_path = base_filepath + core_poi_filename
+        directory, stem = os.path.split(release_path)
+        try:
+            names = os.listdir(directory or '.')
+        except FileNotFoundError:
+            names = []
+
+        loose_parts = {}
+        for name in names:
+            match = CORE_POI_PART_PATTERN.fullmatch(name[len(stem):]) if name.startswith(stem) else None
+            if match:
+                file_index = int(match.group(1))
+                if file_index not in loose_parts or loose_parts[file_index].endswith('.gz'):
+                    loose_parts[file_index] = name
+        has_csv_parts = any(not name.endswith('.gz') for name in loose_parts.values())
+
+        if (not has_csv_parts) and (stem + '.zip' in names):
+            with ZipFile(release_path + '.zip') as zip_file:
+                members = sorted([file for file in zip_file.namelist() if file.endswith('csv.gz')])
+            return [(release_path + '.zip', member) for member in members]
+        if loose_parts:
+            return [(os.path.join(directory, loose_parts[file_index]), None) for file_index in sorted(loose_parts)]
+        raise FileNotFoundError(f"No core_poi parts or zip archive found for {release_path}")
+
+
+    def _open_core_poi_parts(self, core_poi_parts):
+        """
+        This function yields (label, file, compression) for each part listed by core_poi_parts, ready to be passed to pd.read_csv.
+        A zip archive is opened once and its members are streamed from the open archive.
+        """
+        zip_file = None
+        try:
+            for path, member in core_poi_parts:
+                if member is None:
+                    yield path, path, ('gzip' if path.endswith('.gz') else None)
+                    continue
+                if (zip_file is None) or (zip_file.filename != path):
+                    if zip_file is not None:
+                        zip_file.close()
+                    zip_file = ZipFile(path)
+                with zip_file.open(member, 'r') as csv_gz:
+                    yield path + '/' + member, csv_gz, 'gzip'
+        finally:
+            if zip_file is not None:
+                zip_file.close()
+
+
+    def _region_mask(self, df, region_filter):
+        """
+        This function creates a mask selecting the rows of a core_poi dataframe within region_filter (see POIs).
+        For 'state-city' the keys are city names and the values their region, Eg. ['state-city', {'Houston': 'TX'}].
+        """
+        scale_type = region_filter[0].lower()
+        if scale_type == 'state-city':
+            return (df['region'].isin(region_filter[1].values()) & df['city'].isin(region_filter[1].keys())).values
+        elif scale_type == 'state':
+            return df['region'].isin(region_filter[1].keys()).values
+        return np.ones(len(df), dtype=bool)
+    
+    
+    def _read_core_poi_chunks(self, poi_file, compression, col_names, chunksize=None, max_memory_mb=None, dtype=None):
+        """
+        This function reads the col_names columns of a core_poi part, either whole (default) or as a stream of chunks of chunksize
+        rows. With max_memory_mb the chunk size is adapted from the memory footprint of the rows read so far, so that a chunk
+        and its filtered copies stay within roughly max_memory_mb megabytes.
+        """
+        usecols = lambda column: column in col_names
+        if (chunksize is None) and (max_memory_mb is None):
+            yield pd.read_csv(poi_file, compression=compression, encoding="unicode-escape", usecols=usecols, dtype=dtype)
+            return
+
+        with pd.read_csv(poi_file, compression=compression, encoding="unicode-escape", usecols=usecols, dtype=dtype,
+                         chunksize=chunksize or CHUNK_PROBE_ROWS) as reader:
+            rows = None
+            while True:
+                try:
+                    chunk = reader.get_chunk(rows)
+                except StopIteration:
+                    break
+                if (max_memory_mb is not None) and len(chunk):
+                    row_bytes = chunk.memory_usage(deep=True).sum() / len(chunk)
+                    rows = max(1, int(max_memory_mb * 2**20 / (CHUNK_MEMORY_OVERHEAD * row_bytes)))
+                    if chunksize is not None:
+                        rows = min(rows, chunksize)
+                yield chunk
+
+
+    def POIs(self,naics_codes, region_filter, base_filepath, core_poi_filenames, results_filepath,
+             chunksize=None, max_memory_mb=None, n_workers=1, output_format='csv', index_filepath=None):
         """
         This function extracts the Points or places of interest (POIs) based on the specified naics_code(s).
 
@@ -50,241 +426,536 @@ class Extract:
 
         region_filter: list
                     Specify a POI filter scale of the format: [scale_type, filter_items] to select regions by an entire state or a city in the state,
-                    where scale_type can be 'state' or 'state-city' and the filter items is a dictionary containing the city or state name and 
-                    corresponding 2-digit ID of type string. Eg. ['state', {'TX':'48'}] or ['state-city', {'Houston': '48'}]
+                    where scale_type can be 'state' or 'state-city' and the filter items is a dictionary containing the state and its 
+                    2-digit ID of type string, or the city name and its state. Eg. ['state', {'TX':'48'}] or ['state-city', {'Houston': 'TX'}]
     
         base_filepath: path
                     A path of type string to your base directory containing all the core POIs
                     
         core_poi_filenames: list
                     Define a list of paths to select core_poi files from all the core POIs in your base_filepath (i.e. subset
-                    of files from your core POIs)
+                    of files from your core POIs). Each entry is a directory prefix of core_poi-partN.csv(.gz) files or the name
+                    of a zip archive without the '.zip' extension; all of its parts are discovered (see core_poi_parts).
     
         results_filepath: path
                     Define a directory to store the results
+
+        chunksize: int
+                    Number of rows of a core_poi part to read, filter and write at a time. Defaults to None (read each part whole).
+                    In streaming mode POIs are de-duplicated in the order the chunks are read. Values are written as they appear
+                    in the core_poi files, so the output files are identical to a whole-part run.
+
+        max_memory_mb: float
+                    A memory ceiling in megabytes for the part being processed. Parts are streamed in chunks sized to stay
+                    within it (and within chunksize, if given). Defaults to None (no ceiling). With n_workers > 1 the ceiling applies per worker.
+
+        n_workers: int
+                    Number of worker processes that decompress, parse and filter core_poi parts in parallel. Defaults to 1 (serial).
+                    The output files are identical to a serial run.
+
+        output_format: str
+                    Specify 'csv' (default) for one csv file per NAICS code (results_filepath + naics_code + '.csv') or 'parquet'
+                    for one parquet dataset per NAICS code (results_filepath + naics_code + '.parquet/') partitioned by region,
+                    with float latitude/longitude and string naics_code columns. Read either back with read_POIs.
+
+        index_filepath: path
+                    A directory for persistent POI indexes (see POI_index). If given, each core_poi release is indexed once and
+                    later calls with other naics_codes or region_filter read only the matching index partitions instead of
+                    rescanning the release. Defaults to None.
     
         Returns csv files of extracted POIs based on specified naics_codes and region_filter and saved in results_filepath directory.
         """
+        if isinstance(naics_codes, str):
+            naics_codes = [naics_codes]
+        extract_all = naics_codes[0].lower() == 'all'
+
+        col_names = POI_COLUMNS
         output_file_list = []
         output_file_writers = []
     
         for i in range(len(naics_codes)):
+            if output_format == 'parquet':
+                # one dataset directory per NAICS code, partitioned by region
+                output_dataset = results_filepath + naics_codes[i] + '.parquet'
+                shutil.rmtree(output_dataset, ignore_errors=True)
+                os.makedirs(output_dataset)
+                output_file_list.append(output_dataset)
+                continue
             output_file = open(results_filepath + naics_codes[i] + '.csv', 'w', encoding="utf-8")
             output_file_writer = csv.writer(output_file)
-            col_names = ['safegraph_place_id','parent_safegraph_place_id','location_name',
-                         'safegraph_brand_ids','brands','top_category','sub_category',
-                         'naics_code','latitude','longitude','street_address','city','region',
-                         'postal_code','iso_country_code','phone_number','open_hours','category_tags' ]
             output_file_writer.writerow(col_names)
             output_file_list.append(output_file)
             output_file_writers.append(output_file_writer)
     
-        poi_id_dict = {}
-    
-        for core_poi_filename in core_poi_filenames:
-            for file_index in range(1, 6):
-                try:
-                    input_poi_file_path = base_filepath + core_poi_filename + 'core_poi-part' + str(file_index) + '.csv'
-                    print("Processing " + input_poi_file_path)
-                    df = pd.read_csv(input_poi_file_path, encoding="unicode-escape")
-    
-                    # Apply region filters
-                    if region_filter[0].lower() == 'state-city':
-                        df = df[df['region'].isin(region_filter[1].keys()) & df['city'].isin(region_filter[1].keys())]
-                    elif region_filter[0] == 'state':
-                        df = df[df['region'].isin(region_filter[1].keys())]
+        poi_id_set = set()
     
+        core_poi_parts = []
+        if index_filepath is None:
+            for core_poi_filename in core_poi_filenames:
+                core_poi_parts.extend(self.core_poi_parts(base_filepath, core_poi_filename))
+        # the core_poi files are read as text, so that every chunk of a part is written with the same values as the whole part
+        filter_args = (region_filter, naics_codes, extract_all, col_names, chunksize, max_memory_mb, str)
+
+        if index_filepath is not None:
+            for core_poi_filename in core_poi_filenames:
+                index_path = self.POI_index(base_filepath, core_poi_filename, index_filepath, chunksize, max_memory_mb)
+                print("Processing " + index_path)
+                for df in self._read_POI_index(index_path, region_filter, naics_codes, extract_all):
+                    df = df[self._region_mask(df, region_filter)]
                     print(f"DataFrame after region filtering: {df.shape[0]} rows")
-    
-                    try:
-                        all = naics_codes.lower()=='all'
-                        if all == True:
-                            for _, unfiltered_row in df.iterrows():
-                                poi_id = unfiltered_row['safegraph_place_id']
-                                if poi_id in poi_id_dict.keys():
-                                    continue
-                                else:
-                                    poi_id_dict[poi_id] = 0
-                                    output_file_writers[naics_codes.index(naics_codes[0])].writerow(unfiltered_row[col_names])
-
-                        else:
-                            for naics_code in naics_codes:
-                                naics_mask = self.get_naics_mask(df, naics_code)
-                                df_filtered = df[naics_mask]
-                                print(f"DataFrame after NAICS filtering ({naics_code}): {df_filtered.shape[0]} rows")
-            
-                                for _, filtered_row in df_filtered.iterrows():
-                                    poi_id = filtered_row['safegraph_place_id']
-                                    if poi_id in poi_id_dict.keys():
-                                        continue
-                                    else:
-                                        poi_id_dict[poi_id] = 0
-                                        output_file_writers[naics_codes.index(naics_code)].writerow(filtered_row[col_names])
-
-                    except AttributeError:
-                        all = naics_codes[0].lower()=='all'
-                        if all == True:
-                            for _, unfiltered_row in df.iterrows():
-                                poi_id = unfiltered_row['safegraph_place_id']
-                                if poi_id in poi_id_dict.keys():
-                                    continue
-                                else:
-                                    poi_id_dict[poi_id] = 0
-                                    output_file_writers[naics_codes.index(naics_codes[0])].writerow(unfiltered_row[col_names])
-
-                        else:
-                            for naics_code in naics_codes:
-                                naics_mask = self.get_naics_mask(df, naics_code)
-                                df_filtered = df[naics_mask]
-                                print(f"DataFrame after NAICS filtering ({naics_code}): {df_filtered.shape[0]} rows")
-            
-                                for _, filtered_row in df_filtered.iterrows():
-                                    poi_id = filtered_row['safegraph_place_id']
-                                    if poi_id in poi_id_dict.keys():
-                                        continue
-                                    else:
-                                        poi_id_dict[poi_id] = 0
-                                        output_file_writers[naics_codes.index(naics_code)].writerow(filtered_row[col_names])
-    
-                except FileNotFoundError:
-                    print("First Read attempt failed")
-                    try:
-                        zip_file = ZipFile(base_filepath + core_poi_filename + '.zip')
-                        unzipped_file = zip_file.namelist()
-                        with zip_file.open(sorted([file for file in unzipped_file if file.endswith('csv.gz')])[file_index - 1], 'r') as csv_gz:
-                            df = pd.read_csv(csv_gz, compression='gzip', encoding="unicode-escape")
-    
-                            # Apply region filters
-                            if region_filter[0].lower() == 'state-city':
-                                df = df[df['region'].isin(region_filter[1].values()) & df['city'].isin(region_filter[1].keys())]
-                            elif region_filter[0] == 'state':
-                                df = df[df['region'].isin(region_filter[1].keys())]
-    
-                            print(f"DataFrame after region filtering: {df.shape[0]} rows")
-    
-                            try:
-                                all = naics_codes.lower()=='all'
-                                if all == True:
-                                    for _, unfiltered_row in df.iterrows():
-                                        poi_id = unfiltered_row['safegraph_place_id']
-                                        if poi_id in poi_id_dict.keys():
-                                            continue
-                                        else:
-                                            poi_id_dict[poi_id] = 0
-                                            output_file_writers[naics_codes.index(naics_codes[0])].writerow(unfiltered_row[col_names])
-
-                                else:
-                                    for naics_code in naics_codes:
-                                        naics_mask = self.get_naics_mask(df, naics_code)
-                                        df_filtered = df[naics_mask]
-                                        print(f"DataFrame after NAICS filtering ({naics_code}): {df_filtered.shape[0]} rows")
-            
-                                        for _, filtered_row in df_filtered.iterrows():
-                                            poi_id = filtered_row['safegraph_place_id']
-                                            if poi_id in poi_id_dict.keys():
-                                                continue
-                                            else:
-                                                poi_id_dict[poi_id] = 0
-                                                output_file_writers[naics_codes.index(naics_code)].writerow(filtered_row[col_names])
-
-                            except AttributeError:
-                                all = naics_codes[0].lower()=='all'
-                                if all == True:
-                                    for _, unfiltered_row in df.iterrows():
-                                        poi_id = unfiltered_row['safegraph_place_id']
-                                        if poi_id in poi_id_dict.keys():
-                                            continue
-                                        else:
-                                            poi_id_dict[poi_id] = 0
-                                            output_file_writers[naics_codes.index(naics_codes[0])].writerow(unfiltered_row[col_names])
-
-                                else:
-                                    for naics_code in naics_codes:
-                                        naics_mask = self.get_naics_mask(df, naics_code)
-                                        df_filtered = df[naics_mask]
-                                        print(f"DataFrame after NAICS filtering ({naics_code}): {df_filtered.shape[0]} rows")
-            
-                                        for _, filtered_row in df_filtered.iterrows():
-                                            poi_id = filtered_row['safegraph_place_id']
-                                            if poi_id in poi_id_dict.keys():
-                                                continue
-                                            else:
-                                                poi_id_dict[poi_id] = 0
-                                                output_file_writers[naics_codes.index(naics_code)].writerow(filtered_row[col_names])
-                    except FileNotFoundError:
-                        print("Second Read attempt failed")
-                        try:
-                            input_poi_file_path = base_filepath + core_poi_filename + 'core_poi-part' + str(file_index) + '.csv.gz'
-                            print("Processing " + input_poi_file_path)
-                            df = pd.read_csv(input_poi_file_path, compression='gzip', encoding="unicode-escape")
-    
-                            # Apply region filters
-                            if region_filter[0].lower() == 'state-city':
-                                df = df[df['region'].isin(region_filter[1].values()) & df['city'].isin(region_filter[1].keys())]
-                            elif region_filter[0] == 'state':
-                                df = df[df['region'].isin(region_filter[1].keys())]
-    
-                            print(f"DataFrame after region filtering: {df.shape[0]} rows")
-
-                            try:
-                                all = naics_codes.lower()=='all'
-                                if all == True:
-                                    for _, unfiltered_row in df.iterrows():
-                                        poi_id = unfiltered_row['safegraph_place_id']
-                                        if poi_id in poi_id_dict.keys():
-                                            continue
-                                        else:
-                                            poi_id_dict[poi_id] = 0
-                                            output_file_writers[naics_codes.index(naics_codes[0])].writerow(unfiltered_row[col_names])
-
-                                else:
-                                    for naics_code in naics_codes:
-                                        naics_mask = self.get_naics_mask(df, naics_code)
-                                        df_filtered = df[naics_mask]
-                                        print(f"DataFrame after NAICS filtering ({naics_code}): {df_filtered.shape[0]} rows")
-            
-                                        for _, filtered_row in df_filtered.iterrows():
-                                            poi_id = filtered_row['safegraph_place_id']
-                                            if poi_id in poi_id_dict.keys():
-                                                continue
-                                            else:
-                                                poi_id_dict[poi_id] = 0
-                                                output_file_writers[naics_codes.index(naics_code)].writerow(filtered_row[col_names])
-
-                            except AttributeError:
-                                all = naics_codes[0].lower()=='all'
-                                if all == True:
-                                    for _, unfiltered_row in df.iterrows():
-                                        poi_id = unfiltered_row['safegraph_place_id']
-                                        if poi_id in poi_id_dict.keys():
-                                            continue
-                                        else:
-                                            poi_id_dict[poi_id] = 0
-                                            output_file_writers[naics_codes.index(naics_codes[0])].writerow(unfiltered_row[col_names])
-
-                                else:
-                                    for naics_code in naics_codes:
-                                        naics_mask = self.get_naics_mask(df, naics_code)
-                                        df_filtered = df[naics_mask]
-                                        print(f"DataFrame after NAICS filtering ({naics_code}): {df_filtered.shape[0]} rows")
-            
-                                        for _, filtered_row in df_filtered.iterrows():
-                                            poi_id = filtered_row['safegraph_place_id']
-                                            if poi_id in poi_id_dict.keys():
-                                                continue
-                                            else:
-                                                poi_id_dict[poi_id] = 0
-                                                output_file_writers[naics_codes.index(naics_code)].writerow(filtered_row[col_names])
-                        except FileNotFoundError:
-                            print("Oh God")
-                            raise FileNotFoundError("All attempts failed.")
+                    df, code_index = self._select_POIs(df, naics_codes, extract_all)
+                    self._write_POIs(df, code_index, poi_id_set, output_file_list, col_names, output_format)
+        elif n_workers > 1:
+            # parts are filtered in parallel and written back in part order, exactly as a serial run would
+            with ProcessPoolExecutor(max_workers=n_workers) as executor:
+                part_results = executor.map(self._extract_core_poi_part, core_poi_parts,
+                                            *[repeat(arg) for arg in filter_args])
+                for selected_chunks in part_results:
+                    for df, code_index in selected_chunks:
+                        self._write_POIs(df, code_index, poi_id_set, output_file_list, col_names, output_format)
+        else:
+            for input_poi_file_path, poi_file, compression in self._open_core_poi_parts(core_poi_parts):
+                print("Processing " + input_poi_file_path)
+                for df, code_index in self._filter_core_poi_part(poi_file, compression, *filter_args):
+                    self._write_POIs(df, code_index, poi_id_set, output_file_list, col_names, output_format)
     
         print('Relevant POIs Successfully extracted!')
         for output_file in output_file_list:
-            output_file.close()
+            if output_format != 'parquet':
+                output_file.close()
         #print(open(results_filepath + naics_codes[i] + '.csv').read())
         return output_file_list
 
+    def POI_index(self, base_filepath, core_poi_filename, index_filepath, chunksize=None, max_memory_mb=None):
+        """
+        This function returns the path of the on-disk POI index of a core_poi release, building it first if it is missing or
+        stale. The index is a parquet dataset (index_filepath + core_poi_filename + '.index/') holding the POI_COLUMNS of every
+        POI as text, partitioned by region and 2-digit NAICS prefix (naics_prefix), with the part (_part) and position (_row)
+        of each POI in the release so that it is read back chunk by chunk in release order. It is stale when the size or modification time of a source file changes.
+
+        base_filepath, core_poi_filename: path, str
+                    The core_poi release to index (see core_poi_parts).
+
+        index_filepath: path
+                    A directory to store the POI indexes.
+
+        chunksize, max_memory_mb:
+                    Streaming options used while building the index (see POIs). The index is read back in chunks of the same
+                    rows, so reading it stays within the same memory bound.
+        """
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        core_poi_parts = self.core_poi_parts(base_filepath, core_poi_filename)
+        sources = self._file_fingerprints([path for path, _ in core_poi_parts])
+        index_path = index_filepath + core_poi_filename.rstrip('/') + '.index'
+        if self._current_manifest(index_path, sources) is not None:
+            return index_path
+
+        print("Building POI index " + index_path)
+        self._reset_cache(index_path)
+        row_number = 0
+        for part_number, (input_poi_file_path, poi_file, compression) in enumerate(self._open_core_poi_parts(core_poi_parts)):
+            print("Indexing " + input_poi_file_path)
+            for df in self._read_core_poi_chunks(poi_file, compression, POI_COLUMNS, chunksize, max_memory_mb, dtype=str):
+                df = df[POI_COLUMNS].astype('string')
+                df['naics_prefix'] = self.get_naics_strings(df).str[:2].astype('string')
+                df['_part'] = np.full(len(df), part_number, dtype='int64')
+                df['_row'] = np.arange(row_number, row_number + len(df), dtype='int64')
+                pq.write_to_dataset(pa.Table.from_pandas(df, preserve_index=False), index_path,
+                                    partition_cols=['region', 'naics_prefix'],
+                                    basename_template=f'part-{row_number:012d}-{{i}}.parquet')
+                row_number += len(df)
+
+        self._write_manifest(index_path, {'release': base_filepath + core_poi_filename, 'sources': sources})
+        return index_path
+
+
+    def _read_POI_index(self, index_path, region_filter, naics_codes, extract_all):
+        """
+        This function yields the POIs of a POI index chunk by chunk in release order, loading only the region and NAICS prefix
+        partitions that region_filter and naics_codes can match.
+        """
+        import pyarrow as pa
+        import pyarrow.dataset as ds
+        partitioning = ds.partitioning(pa.schema([('region', pa.string()), ('naics_prefix', pa.string())]), flavor='hive')
+        dataset = ds.dataset(index_path, format='parquet', partitioning=partitioning)
+
+        partition_filter = None
+        scale_type = region_filter[0].lower()
+        if scale_type in ('state', 'state-city'):
+            regions = region_filter[1].keys() if scale_type == 'state' else region_filter[1].values()
+            partition_filter = ds.field('region').isin(list(regions))
+        if (not extract_all) and all(len(naics_code) >= 2 for naics_code in naics_codes):
+            naics_filter = ds.field('naics_prefix').isin(sorted({naics_code[:2] for naics_code in naics_codes}))
+            partition_filter = naics_filter if partition_filter is None else (partition_filter & naics_filter)
+
+        # the files of an indexed chunk share the first row of the chunk in their name, so the index is loaded one chunk at a
+        # time, in release order, and never holds more rows than the chunks it was built from
+        fragments = sorted(dataset.get_fragments(filter=partition_filter), key=lambda fragment: os.path.basename(fragment.path))
+        for _, chunk_fragments in groupby(fragments, key=lambda fragment: os.path.basename(fragment.path).rsplit('-', 1)[0]):
+            chunk = ds.FileSystemDataset(list(chunk_fragments), dataset.schema, dataset.format, dataset.filesystem)
+            df = chunk.to_table().to_pandas()
+            if df.empty:
+                continue
+            df = df.sort_values('_row').reset_index(drop=True)
+            df['region'] = df['region'].astype('string')
+            yield df[POI_COLUMNS]
+
+
+    def _file_fingerprints(self, paths):
+        """
+        This function returns [path, size, modification time] of each distinct file in paths, to detect changed inputs.
+        """
+        fingerprints = []
+        for path in dict.fromkeys(paths):
+            file_stat = os.stat(path)
+            fingerprints.append([path, file_stat.st_size, file_stat.st_mtime_ns])
+        return fingerprints
+
+
+    def _current_manifest(self, cache_path, sources, field='sources'):
+        """
+        This function returns the manifest (cache_path + '/_manifest.json') of an on-disk cache (POI index, geometry cache or
+        weekly visits cache) if its field holds the fingerprints sources (see _file_fingerprints), and None if the cache is
+        missing, was interrupted or is stale.
+        """
+        try:
+            with open(os.path.join(cache_path, '_manifest.json'), 'r') as manifest_file:
+                manifest = json.load(manifest_file)
+            if manifest[field] == sources:
+                return manifest
+        except (FileNotFoundError, ValueError, KeyError, TypeError):
+            pass
+        return None
+
+
+    def _reset_cache(self, cache_path):
+        """
+        This function empties the directory of an on-disk cache (and so its manifest) before the cache is built.
+        """
+        shutil.rmtree(cache_path, ignore_errors=True)
+        os.makedirs(cache_path)
+
+
+    def _write_manifest(self, cache_path, manifest):
+        """
+        This function writes the manifest of an on-disk cache once the cache is complete. It is written last, so an
+        interrupted build has no manifest and is redone by the next call.
+        """
+        with open(os.path.join(cache_path, '_manifest.json'), 'w') as manifest_file:
+            json.dump(manifest, manifest_file)
+
+
+    def _filter_core_poi_part(self, poi_file, compression, region_filter, naics_codes, extract_all, col_names,
+                              chunksize=None, max_memory_mb=None, dtype=None):
+        """
+        This function reads a core_poi part (whole or in chunks) and yields the (df, code_index) selection of _select_POIs
+        for each region filtered chunk.
+        """
+        for df in self._read_core_poi_chunks(poi_file, compression, col_names, chunksize, max_memory_mb, dtype):
+            # Apply region filters
+            df = df[self._region_mask(df, region_filter)]
+            print(f"DataFrame after region filtering: {df.shape[0]} rows")
+
+            yield self._select_POIs(df, naics_codes, extract_all)
+
+
+    def _extract_core_poi_part(self, core_poi_part, *filter_args):
+        """
+        This function is the process pool worker of POIs: it decompresses, parses and filters one (path, member) part
+        returned by core_poi_parts and returns the list of its selected chunks.
+        """
+        for input_poi_file_path, poi_file, compression in self._open_core_poi_parts([core_poi_part]):
+            print("Processing " + input_poi_file_path)
+            return list(self._filter_core_poi_part(poi_file, compression, *filter_args))
+
+
+    def _select_POIs(self, df, naics_codes, extract_all):
+        """
+        This function selects the POIs of a (region filtered) dataframe that match naics_codes and orders them for writing:
+        code by code in the order of naics_codes and in file order within a code, keeping the first row of a repeated
+        safegraph_place_id. Returns the selected dataframe and the index in naics_codes of the code of each of its rows.
+        """
+        if extract_all:
+            code_index = np.zeros(len(df), dtype='int64')
+        else:
+            naics_assigned = self.get_naics_codes(df, naics_codes)
+            first_index = {}
+            for i, naics_code in enumerate(naics_codes):
+                first_index.setdefault(naics_code, i)
+                print(f"DataFrame after NAICS filtering ({naics_code}): {(naics_assigned.values == naics_code).sum()} rows")
+            code_index = naics_assigned.map(first_index).fillna(-1).values.astype('int64')
+
+        keep = code_index >= 0
+        df, code_index = df[keep], code_index[keep]
+        order = np.argsort(code_index, kind='stable')
+        df, code_index = df.iloc[order], code_index[order]
+
+        new = (~df['safegraph_place_id'].duplicated()).values
+        return df[new], code_index[new]
+
+
+    def _write_POIs(self, df, code_index, poi_id_set, output_file_list, col_names, output_format='csv'):
+        """
+        This function appends the POIs selected by _select_POIs to the output file (or parquet dataset) of their NAICS code in
+        a single write per code. A safegraph_place_id already written from an earlier chunk, part or release (as recorded in
+        poi_id_set) is dropped, so the first seen POI wins.
+        """
+        # the set is probed id by id: Series.isin would rebuild a lookup over every id written so far on each call
+        poi_ids = df['safegraph_place_id'].tolist()
+        new = np.fromiter((poi_id not in poi_id_set for poi_id in poi_ids), dtype=bool, count=len(poi_ids))
+        df, code_index = df[new], code_index[new]
+        # the number of POIs written so far numbers the parquet files of this write uniquely and in write order
+        write_number = len(poi_id_set)
+        poi_id_set.update(df['safegraph_place_id'].tolist())
+
+        if output_format == 'parquet':
+            df = self._typed_POIs(df[col_names])
+        for i in np.unique(code_index):
+            if output_format == 'parquet':
+                self._append_POIs_parquet(df[code_index == i], output_file_list[i], write_number)
+            else:
+                df[code_index == i][col_names].to_csv(output_file_list[i], header=False, index=False,
+                                                       na_rep='nan', lineterminator='\r\n')
+
+
+    def _typed_POIs(self, df):
+        """
+        This function types the columns of POIs read as text for parquet output: float latitude and longitude, the naics_code as
+        a string of digits and every other column as a string.
+        """
+        df = df.astype('string')
+        df['latitude'] = pd.to_numeric(df['latitude'], errors='coerce').astype('float64')
+        df['longitude'] = pd.to_numeric(df['longitude'], errors='coerce').astype('float64')
+        df['naics_code'] = self.get_naics_strings(df).astype('string')
+        return df
+
+
+    def _append_POIs_parquet(self, df, output_dataset, write_number):
+        """
+        This function appends POIs to a parquet dataset directory partitioned by region (output_dataset/region=TX/...).
+        """
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        pq.write_to_dataset(table, output_dataset, partition_cols=['region'],
+                            basename_template=f'part-{write_number:012d}-{{i}}.parquet')
+
+
+    def read_POIs(self, POI_filepath, naics_code, columns=None):
+        """
+        This function loads the POIs extracted by POIs for one NAICS code, from its parquet dataset (POI_filepath + naics_code
+        + '.parquet') if there is one and from its csv file (POI_filepath + naics_code + '.csv') otherwise.
+
+        POI_filepath: path
+                    A path of type string to your directory containing the extracted POI files
+
+        naics_code: str
+                    The NAICS code the POIs were extracted for. Eg. '611110'
+
+        columns: list
+                    The columns to load. Defaults to None (all columns). Only these columns are read from disk.
+
+        Returns a pandas dataframe of the POIs with float latitude and longitude and string safegraph_place_id.
+        """
+        parquet_path = POI_filepath + naics_code + '.parquet'
+        if os.path.isdir(parquet_path):
+            if not any(files for _, _, files in os.walk(parquet_path)):
+                # no POI of this NAICS code was extracted
+                return pd.DataFrame(columns=columns)
+            df = pd.read_parquet(parquet_path, columns=columns)
+            if 'region' in df.columns:
+                # the region partition is loaded as a categorical
+                df['region'] = df['region'].astype('string')
+            return df
+        return pd.read_csv(POI_filepath + naics_code + '.csv', usecols=columns,
+                           dtype={'safegraph_place_id': str})
+
+
+    def resolve_schema(self, file_path, schema):
+        """
+        This function reads only the header of a csv (or .csv.gz) file and resolves the position of every field of schema in it.
+
+        file_path: path
+                    The csv file. Eg. a weekly patterns .csv.gz or a home_panel_summary .csv file.
+
+        schema: dict
+                    Field name -> list of accepted header names in order of preference. Eg. PATTERNS_SCHEMA or HOME_PANEL_SCHEMA
+
+        Returns a dictionary of field name -> column position. Raises a ValueError naming the file and the fields it lacks.
+        """
+        opener = gzip.open if file_path.endswith('.gz') else open
+        with opener(file_path, 'rt') as csv_file:
+            header = next(csv.reader(csv_file, delimiter=',', quotechar='"'), [])
+        positions = {column.strip(): position for position, column in reversed(list(enumerate(header)))}
+
+        columns = {}
+        missing = []
+        for field, names in schema.items():
+            position = next((positions[name] for name in names if name in positions), None)
+            if position is None:
+                missing.append(field)
+            else:
+                columns[field] = position
+        if missing:
+            raise ValueError(f"{file_path} has no column for {', '.join(missing)} (header: {', '.join(header)})")
+        return columns
+
+
+    def load_home_panel_summary(self, panel_file_paths, cbg_prefixes=None, panel_columns=None):
+        """
+        This function loads home_panel_summary csv files into a table of the number of devices residing (samplesize) per week
+        and CBG, summed over all the files, read once and grouped in vectorized form.
+
+        panel_file_paths: list
+                    The paths of the home_panel_summary csv files.
+
+        cbg_prefixes: tuple
+                    Keep only CBGs starting with one of these county FIPS codes or tract GEOIDs. Defaults to None (all CBGs).
+
+        panel_columns: list
+                    The HOME_PANEL_SCHEMA columns of each file, as returned by resolve_schema. Resolved here if not given.
+
+        Returns a pandas dataframe with a samplesize column, indexed by (date_range_start, date_range_end, Census_Block_Groups)
+        so that it can be joined to the weekly visits; a week and CBG missing from it joins as a null samplesize.
+        """
+        week_keys = ['date_range_start', 'date_range_end', 'Census_Block_Groups']
+        if panel_columns is None:
+            panel_columns = [self.resolve_schema(path, HOME_PANEL_SCHEMA) for path in panel_file_paths]
+        panel_frames = []
+        for input_panel_size_file_path, columns in zip(panel_file_paths, panel_columns):
+            print("Processing "+input_panel_size_file_path)
+            positions = [columns['date_range_start'], columns['date_range_end'],
+                         columns['census_block_group'], columns['number_devices_residing']]
+            df_panel = pd.read_csv(input_panel_size_file_path, usecols=positions, dtype=str)
+            df_panel = df_panel.iloc[:, np.argsort(np.argsort(positions))]
+            df_panel.columns = week_keys + ['samplesize']
+            if cbg_prefixes:
+                df_panel = df_panel[df_panel['Census_Block_Groups'].str.startswith(cbg_prefixes)]
+            panel_frames.append(df_panel)
+        if not panel_frames:
+            return pd.DataFrame({'samplesize': pd.Series(dtype='int64')},
+                                index=pd.MultiIndex.from_arrays([[], [], []], names=week_keys))
+
+        df_panel = pd.concat(panel_frames, ignore_index=True)
+        df_panel['date_range_start'] = df_panel['date_range_start'].str[0:10]
+        df_panel['date_range_end'] = df_panel['date_range_end'].str[0:10]
+        df_panel['samplesize'] = df_panel['samplesize'].astype('int64')
+        return df_panel.groupby(week_keys, sort=False)[['samplesize']].sum()
+
+
+    def _aggregate_pattern_files(self, pattern_file_paths, pattern_columns, poi_naics_dict, cbg_prefixes, n_workers=1):
+        """
+        This function aggregates the weekly patterns .csv.gz files of pattern_file_paths (see _aggregate_pattern_file), serially
+        or with n_workers processes each aggregating whole files into partial aggregates that are merged in file order.
+        Returns the (visits dict, visitors dict, ODAccumulator) aggregate.
+        """
+        aggregate = ({}, {}, ODAccumulator())
+        if n_workers > 1:
+            with ProcessPoolExecutor(max_workers=n_workers, initializer=_init_pattern_worker,
+                                     initargs=(poi_naics_dict, cbg_prefixes)) as executor:
+                for partial_aggregate in executor.map(_aggregate_pattern_file_worker, pattern_file_paths, pattern_columns):
+                    self._merge_pattern_aggregates(aggregate, partial_aggregate)
+        else:
+            for input_pattern_file_path, columns in zip(pattern_file_paths, pattern_columns):
+                self._aggregate_pattern_file(input_pattern_file_path, columns, poi_naics_dict, cbg_prefixes, aggregate)
+        return aggregate
+
+
+    def _aggregate_pattern_file(self, input_pattern_file_path, pattern_columns, poi_naics_dict, cbg_prefixes, aggregate=None):
+        """
+        This function sums the visits, visitors and visitor home CBGs of the POIs in poi_naics_dict (poi_id -> naics_code)
+        whose poi_cbg starts with one of cbg_prefixes, in one weekly patterns .csv.gz file, by the key
+        (date_range_start, date_range_end, poi_cbg, poi_id, location_name, naics_code). pattern_columns gives the position of each
+        PATTERNS_SCHEMA field in a row (see resolve_schema). Rows are added to aggregate, a (visits dict, visitors dict,
+        ODAccumulator) tuple, or to a new one if it is None. Returns the aggregate.
+        """
+        if aggregate is None:
+            aggregate = ({}, {}, ODAccumulator())
+        cbg_week_visits_dict, cbg_week_visitors_dict, home_cbg_week_visitors = aggregate
+        poi_id_col = pattern_columns['poi_id']
+        poi_cbg_col = pattern_columns['poi_cbg']
+        start_col = pattern_columns['date_range_start']
+        end_col = pattern_columns['date_range_end']
+        name_col = pattern_columns['location_name']
+        visits_col = pattern_columns['raw_visit_counts']
+        visitors_col = pattern_columns['raw_visitor_counts']
+        home_cbgs_col = pattern_columns['visitor_home_cbgs']
+
+        print("Processing "+input_pattern_file_path)
+        with gzip.open(input_pattern_file_path, 'rt') as csv_file:
+            # rows of POIs that are not a specified movement NAICS code in the specified region are never parsed
+            for naics_code, row in self._matching_pattern_rows(csv_file, poi_naics_dict, poi_id_col):
+                poi_cbg = row[poi_cbg_col]
+                if not poi_cbg.startswith(cbg_prefixes):
+                    continue
+                constructed_output_id = (row[start_col][0:10], row[end_col][0:10], poi_cbg, row[poi_id_col], row[name_col],
+                                         naics_code)
+                visits = int(row[visits_col])
+                visitors = int(row[visitors_col])
+
+                if constructed_output_id in cbg_week_visits_dict:
+                    cbg_week_visits_dict[constructed_output_id] = cbg_week_visits_dict[constructed_output_id] + visits
+                    cbg_week_visitors_dict[constructed_output_id] = cbg_week_visitors_dict[constructed_output_id] + visitors
+                else:
+                    cbg_week_visits_dict[constructed_output_id] = visits
+                    cbg_week_visitors_dict[constructed_output_id] = visitors
+                home_cbg_week_visitors.add(constructed_output_id, parse_home_cbgs(row[home_cbgs_col]))
+        return aggregate
+
+
+    def _merge_pattern_aggregates(self, aggregate, partial_aggregate):
+        """
+        This function adds a partial (visits dict, visitors dict, ODAccumulator) aggregate into aggregate in place.
+        Keys and home CBGs new to aggregate are appended in the order of partial_aggregate.
+        """
+        cbg_week_visits_dict, cbg_week_visitors_dict, home_cbg_week_visitors = aggregate
+        partial_visits_dict, partial_visitors_dict, partial_home_cbg_visitors = partial_aggregate
+        for constructed_output_id, visits in partial_visits_dict.items():
+            cbg_week_visits_dict[constructed_output_id] = cbg_week_visits_dict.get(constructed_output_id, 0) + visits
+        for constructed_output_id, visitors in partial_visitors_dict.items():
+            cbg_week_visitors_dict[constructed_output_id] = cbg_week_visitors_dict.get(constructed_output_id, 0) + visitors
+        home_cbg_week_visitors.merge(partial_home_cbg_visitors)
+
+
+    def _matching_pattern_rows(self, csv_file, poi_lookup, id_col=0):
+        """
+        This function yields (poi_lookup[poi_id], row) for every row of an open weekly patterns csv file whose POI id (column
+        id_col) is a key of poi_lookup. The id is read off the raw line before the line is parsed, so rows of other POIs
+        are rejected without being split into fields. The header row is skipped.
+        """
+        first_row = True
+        pending_lines = None
+        quote_count = 0
+        for line in csv_file:
+            if pending_lines is not None:
+                # a quoted field spans more than one line: collect the whole record
+                pending_lines.append(line)
+                quote_count += line.count('"')
+                if quote_count % 2:
+                    continue
+                line = ''.join(pending_lines)
+                pending_lines = None
+            elif line.count('"') % 2:
+                pending_lines = [line]
+                quote_count = line.count('"')
+                continue
+
+            if first_row:
+                first_row = False
+                continue
+            leading_fields = line.split(',', id_col + 1)[:id_col + 1]
+            if all(('"' not in field) or (field[0] == field[-1] == '"' and field.count('"') == 2) for field in leading_fields):
+                poi_id = leading_fields[-1].rstrip('\r\n').strip('"')
+            else:
+                # a leading field holds a quoted comma or quote: only a full parse can find the id
+                poi_id = next(csv.reader([line], delimiter=',', quotechar='"'))[id_col]
+            value = poi_lookup.get(poi_id)
+            if value is None:
+                continue
+            yield value, next(csv.reader([line], delimiter=',', quotechar='"'))
+
+
     def add_dicts(self, dict1, dict2):
         result_dict = {}
         for key in dict1:
@@ -297,10 +968,122 @@ class Extract:
                 result_dict[key] = dict2[key]
         return result_dict
 
+    def geometry_cache(self, path_to_shapefile, cache_filepath=None):
+        """
+        This function returns the path of the GeoParquet cache of a shapefile, building it first if it is missing or stale.
+        The cache (cache_filepath + shapefile name + '.geoparquet/') holds the attributes and geometries of the shapefile
+        sorted by GEOID, the LON and LAT of every centroid, and a bbox column so that readers can load a county or a map
+        extent without reading the whole state. It is stale when the size or modification time of a source file (the .shp
+        and its sidecar files) changes.
+
+        path_to_shapefile: str
+                    Define the path to the Shapefile (Eg. Census Tracts or Census Block Groups) for the state or region of interest.
+
+        cache_filepath: path
+                    A directory to store the geometry caches. Defaults to the directory of the shapefile.
+        """
+        shapefile_root, shapefile_extension = os.path.splitext(path_to_shapefile)
+        if cache_filepath is None:
+            cache_path = shapefile_root + '.geoparquet'
+        else:
+            cache_path = cache_filepath + os.path.basename(shapefile_root) + '.geoparquet'
+        # absolute paths, so that the same shapefile reached through another relative path reuses the cache
+        shapefile_root = os.path.abspath(shapefile_root)
+        source_paths = [shapefile_root + shapefile_extension]
+        if shapefile_extension.lower() == '.shp':
+            source_paths += [shapefile_root + extension for extension in ['.shx', '.dbf', '.prj', '.cpg']
+                             if os.path.exists(shapefile_root + extension)]
+        sources = self._file_fingerprints(source_paths)
+        if self._current_manifest(cache_path, sources) is not None:
+            return cache_path
+
+        print("Building geometry cache " + cache_path)
+        self._reset_cache(cache_path)
+        _shapes = gp.read_file(path_to_shapefile)
+        if 'GEOID' in _shapes.columns:
+            _shapes = _shapes.sort_values('GEOID').reset_index(drop=True)
+        centroids = _shapes['geometry'].centroid
+        _shapes['LON'] = centroids.x
+        _shapes['LAT'] = centroids.y
+        _shapes.to_parquet(os.path.join(cache_path, 'geometries.parquet'), index=False, write_covering_bbox=True)
+
+        self._write_manifest(cache_path, {'shapefile': path_to_shapefile, 'sources': sources})
+        return cache_path
+
+
+    def read_geometries(self, path_to_shapefile, county_FIP=None, bbox=None, columns=None, cache_filepath=None):
+        """
+        This function reads the geometries of a shapefile through its geometry cache (see geometry_cache) into a
+        GeoDataFrame with LON and LAT centroid columns.
+
+        path_to_shapefile: str
+                    Define the path to the Shapefile (Eg. Census Tracts or Census Block Groups) for the state or region of interest.
+
+        county_FIP: str
+                    Optional 5-digit string code representing state and county. If given, only the shapes of this county are read.
+
+        bbox: tuple
+                    Optional (min LON, min LAT, max LON, max LAT) extent. If given, only the shapes intersecting it are read.
+
+        columns: list
+                    Optional list of the columns to read. Defaults to all of them.
+
+        cache_filepath: path
+                    A directory to store the geometry caches (see geometry_cache).
+        """
+        cache_path = self.geometry_cache(path_to_shapefile, cache_filepath)
+        geometries_path = os.path.join(cache_path, 'geometries.parquet')
+        _shapes = gp.read_parquet(geometries_path, columns=columns, bbox=bbox,
+                                  filters=self._county_filters(geometries_path, county_FIP))
+        return _shapes.reset_index(drop=True)
+
+
+    def _county_filters(self, geometries_path, county_FIP):
+        """
+        This function returns the parquet filters selecting the shapes of county_FIP in a geometry cache, or None.
+        """
+        if county_FIP is None:
+            return None
+        import pyarrow.parquet as pq
+        if {'STATEFP', 'COUNTYFP'} <= set(pq.read_schema(geometries_path).names):
+            return [('STATEFP', '=', county_FIP[:2]), ('COUNTYFP', '=', county_FIP[2:])]
+        return [('GEOID', '>=', county_FIP), ('GEOID', '<', county_FIP[:-1] + chr(ord(county_FIP[-1]) + 1))]
+
+
+    def centroid_index(self, path_to_shapefile, county_FIP=None, cache_filepath=None):
+        """
+        This function reads a Census Tracts or Census Block Groups shapefile into a table of centroids indexed by GEOID, so
+        that tract or CBG attributes are attached to flows with a join instead of a search per row. The centroids are read
+        from the geometry cache of the shapefile (see geometry_cache) without loading any geometry.
+
+        path_to_shapefile: str
+                    Define the path to the Census Tracts or Census Block Groups Shapefile for the state or region of interest.
+
+        county_FIP: str
+                    Optional 5-digit string code representing state and county. If given, only the tracts or CBGs of this
+                    county are kept.
+
+        cache_filepath: path
+                    A directory to store the geometry caches (see geometry_cache).
+
+        Returns a dataframe indexed by GEOID with the STATEFP, COUNTYFP, TRACTCE (and BLKGRPCE for CBGs) columns of the
+        shapefile and the LON and LAT of every centroid.
+        """
+        import pyarrow.parquet as pq
+        geometries_path = os.path.join(self.geometry_cache(path_to_shapefile, cache_filepath), 'geometries.parquet')
+        shape_columns = pq.read_schema(geometries_path).names
+        code_columns = [column for column in ['STATEFP', 'COUNTYFP', 'TRACTCE', 'BLKGRPCE'] if column in shape_columns]
+        _centroid_index = pd.read_parquet(geometries_path, columns=['GEOID'] + code_columns + ['LON', 'LAT'],
+                                          filters=self._county_filters(geometries_path, county_FIP))
+        return _centroid_index.set_index('GEOID')
+
+
     def county_weekly_visits(self, base_filepath, POI_filepath, weekly_pattern_filepaths, path_to_shapefile_CBG,
                                  path_to_shapefile_CT, path_to_save_weekly_patterns, path_to_save_weekly_flow_format,
                                  naics_codes, naics_names, date_range_end, county_FIP, df_weekly_visits_avail=True,
-                                extract_based_on='Census Tracts', kepler_format='Yes', demo_data = True):
+                                extract_based_on='Census Tracts', kepler_format='Yes', demo_data = True, cbg_filter=None,
+                                n_workers=1, distance_mode='ellipsoidal', verbose=False, incremental=False, outputs=None,
+                                output_format='csv', output_chunksize=None, cache_filepath=None):
         """
         This function extracts weekly flows (visit and or visitor counts) based on the specified naics_code(s) for a given county.
     
@@ -308,14 +1091,15 @@ class Extract:
                     A path of type string to your base directory containing all the weekly places patterns data
     
         POI_filepath: path
-                    A path of type string to your directory containing selected extracted POI csv file
+                    A path of type string to your directory containing selected extracted POI csv file or parquet dataset (see read_POIs)
     
         weekly_pattern_filepaths: list
                     Define a list of paths to select weekly places pattern files from all the weekly places patterns data in your base_filepath (i.e. subset
                     of files from your weekly places patterns data)
     
         path_to_save_weekly_patterns: str
-                    Define a directory to store the results for the extracted weekly places patterns.
+                    Define a directory to store the results for the extracted weekly places patterns (one row per POI, CBG and
+                    week, keyed by safegraph_place_id).
     
         path_to_shapefile_CBG: str (required)
                     Define the path to the Census Blocks Shapefile for the state or region of interest.
@@ -340,517 +1124,583 @@ class Extract:
     
         df_weekly_visits_avail: Boolean
                     Specify True or False to specify whether dataframe of county weekly raw visits and visitor flows is already available or not. 
-                    If False, first extract the weekly county raw visits and visitor counts and stores it as a csv file first.
-                    If True, skip this process.
+                    If False, first extract the weekly county raw visits and visitor counts and stores it as a csv file first,
+                    along with a parquet cache (path_to_save_weekly_patterns + '.cache/') keyed by the fingerprints of the input
+                    files; the extraction is skipped when the cache was built from the same inputs.
+                    If True, skip this process and load the weekly visits from their cache (or from the csv file if it has none).
     
         date_range_end: str
                     End date for selection of the week interested in. Eg. for week 1: '2021-01-04'
     
         extract_based_on: str
-                    Specify whether to extract weekly visits and provide outputs based on 'CBGs', 'Census Tracts' or 'both'. Defaults to 'both'
+                    Specify whether to extract weekly visits and provide outputs based on 'CBGs', 'Census Tracts' or 'both'.
+                    CBG flows are written with the suffix '-CBG' (Eg. '-kepler-CBG.csv') and tract flows with '-CT'; 'both'
+                    builds the CBG flows once and rolls them up to tracts. Defaults to 'Census Tracts'
     
         kepler_format: str
                     Specify whether 'Yes' or 'No'. 'Yes' provides output results in a kepler format. Defaults to 'Yes'
+
+        demo_data: Boolean
+                    Specify True for the demo data layout, where all home panel summary files sit directly in
+                    base_filepath/home_panel_summary/, or False for the production layout mirroring weekly_pattern_filepaths.
+                    The columns of every file are resolved from its header (see PATTERNS_SCHEMA and HOME_PANEL_SCHEMA).
+                    Defaults to True
+
+        cbg_filter: list
+                    A list of county FIPS codes (5 digits) and or Census Tract GEOIDs (11 digits) applied to the poi_cbg of every
+                    weekly patterns row (and the CBG of every home panel summary row) while scanning, so that visits of POIs
+                    outside them are never stored. A single code may be given as a string. Defaults to [county_FIP].
+
+        n_workers: int
+                    Number of worker processes aggregating weekly patterns files in parallel (one file per task); their partial
+                    aggregates are merged in file order, so results are identical to a serial run. Defaults to 1 (serial).
+
+        distance_mode: str
+                    Accuracy mode of the Distance_Covered (km) column: 'haversine', 'ellipsoidal' or 'geodesic' (see distance_km).
+                    Defaults to 'ellipsoidal'
+
+        verbose: Boolean
+                    Specify True to print the extracted weekly visits csv file to stdout. Defaults to False
+
+        incremental: Boolean
+                    Specify True to extract only the weekly patterns and home panel summary files that are new since the last
+                    extraction into path_to_save_weekly_patterns and merge them into the stored weekly visits, without
+                    rescanning the files already ingested. The weekly visits are rebuilt from all files when an ingested file
+                    has changed or was removed, or when naics_codes, the CBG filter or the POI files have changed.
+                    Defaults to False
+
+        outputs: list
+                    The flow outputs to write in one pass, any of 'kepler' (path_to_save_weekly_flow_format + '-kepler-CT'),
+                    'full' (all columns, + '-CT') and 'network_analysis' (+ '-network_analysis-CT'), with '-CBG' instead of
+                    '-CT' for CBG flows. Defaults to None, i.e. ['kepler'] if kepler_format is 'Yes' and
+                    ['full', 'network_analysis'] otherwise.
+
+        output_format: str
+                    Specify 'csv' (default), 'csv.gz' (gzip compressed csv) or 'parquet' for the flow outputs.
+
+        output_chunksize: int
+                    Number of rows of the flow table written at a time. Defaults to FLOW_WRITE_CHUNK_ROWS.
+
+        cache_filepath: path
+                    A directory to store the geometry caches of the shapefiles (see geometry_cache), Eg. when the shapefile
+                    directory is read-only. Defaults to None (the directory of each shapefile).
         
         Returns csv files of extracted weekly visitor flow patterns based on specified naics_codes and stores them in path_to_save_weekly_flow_format directory.
         
         """
-        if (df_weekly_visits_avail==False) & (demo_data==False):
-            # step 1: get the ids of specified POI outlets
-            movement_outlet_list = []
-            lat_list = []
-            lon_list = []
-            for i in range(len(naics_codes)):
-                _store_id_dict = {}
-                _lat_id_dict = {}
-                _lon_id_dict = {}
-                with open(POI_filepath+naics_codes[i]+'.csv', 'r') as csv_file:
-                    file_reader = csv.reader(csv_file, delimiter=',', quotechar='"')
-                    first_row= True
-                    for row in file_reader:
-                        if first_row:
-                            first_row = False
-                            continue   
-        
-                        _store_id = row[0]
-                        _store_id_dict[_store_id] = 0
-                        _lat_id = row[8] 
-                        _lat_id_dict[_lat_id] = 8
-                        _lon_id = row[9]
-                        _lon_id_dict[_lat_id] = 9
-        
-                movement_outlet_list.append(_store_id_dict)
-                lat_list.append(_lat_id_dict)
-                lon_list.append(_lon_id_dict)
-                
-            # step 2: go through the weekly patterns file
-            cbg_week_visits_dict = {}
-            cbg_week_visitors_dict = {}
-            home_cbg_week_visitors_dict = {}
-            for path in weekly_pattern_filepaths:
-                weekly_pattern_files = sorted(os.listdir(base_filepath+'patterns/'+path))
-                for this_pattern_file in weekly_pattern_files:
-                    if this_pattern_file.endswith(".csv.gz"):
-                        #print(path,this_pattern_file)
-                        input_pattern_file_path = base_filepath+'patterns/'+path+this_pattern_file
-                        print("Processing "+input_pattern_file_path)
-        
-                        with gzip.open(input_pattern_file_path, 'rt') as csv_file:
-                            file_reader = csv.reader(csv_file, delimiter=',', quotechar='"')
-                            first_row= True
-                            for row in file_reader:
-                                #print(row)
-                                if first_row:
-                                    first_row = False
-                                    continue
-        
-                                # if this POI is not a specified movement NAICS code in the specified region, continue
-                                poi_id = row[0]
-                                for i in range(len(naics_codes)):
-                                    if poi_id in movement_outlet_list[i].keys():
-                                        #print(poi_id)
-                                        poi_cbg = row[18]#[0:5]
-                                        date_range_start = row[12][0:10]
-                                        date_range_end = row[13][0:10]
-                                        naics_code = naics_codes[i]
-                                        location_name = row[4]
-        
-                                        visits = int(row[14])
-                                        visitors = int(row[15])
-                                        extracted_dict = eval(re.search(r"\{(.*?)\}", row[19]).group(0))
-        
-                                        constructed_output_id = date_range_start+"|"+date_range_end+"|"+poi_cbg+"|"+location_name+"|"+naics_code
-        
-                                        if constructed_output_id in cbg_week_visits_dict.keys():
-                                            cbg_week_visits_dict[constructed_output_id] =  cbg_week_visits_dict[constructed_output_id] + visits
-                                            cbg_week_visitors_dict[constructed_output_id] = cbg_week_visitors_dict[constructed_output_id] + visitors
-                                            home_cbg_week_visitors_dict[constructed_output_id] = self.add_dicts(home_cbg_week_visitors_dict[constructed_output_id],extracted_dict)
-                                        else:
-                                            cbg_week_visits_dict[constructed_output_id] =   visits
-                                            cbg_week_visitors_dict[constructed_output_id] =  visitors
-                                            home_cbg_week_visitors_dict[constructed_output_id] = extracted_dict
-        
-            
-            
-            print()
-            print()
-            print("DONE PROCESSING WEEKLY PATTERN FILES!!")
-            print()
-            print()
-            
-            ### Apply filter to select only specified county
-            dictfilt = lambda x, y: dict([ (i,x[i]) for i in x if i in set(y) ])
-            filter_opt = [year for year in list(cbg_week_visits_dict.keys()) if ('|'+county_FIP in year)]
-            cbg_week_visits_dict_filtered = dictfilt(cbg_week_visits_dict, filter_opt)
-            cbg_week_visitors_dict_filtered = dictfilt(cbg_week_visitors_dict, filter_opt)
-            home_cbg_week_visitors_dict_filtered = dictfilt(home_cbg_week_visitors_dict, filter_opt)
-        
-            # step 3: go through the sample size file
-            cbg_week_samplesize_dict = {}
-        
-            for path in weekly_pattern_filepaths:
-                cbg_week_files = sorted(os.listdir(base_filepath+'home_panel_summary/'+path))
-        
-                for cbg_week_samplesize_file in cbg_week_files:
-                    if cbg_week_samplesize_file.endswith(".csv"):
-                        input_panel_size_file_path = base_filepath+'home_panel_summary/'+path+cbg_week_samplesize_file
-                        print("Processing "+input_panel_size_file_path)
-        
-                        with open(input_panel_size_file_path, 'r') as csv_file:
-                            file_reader = csv.reader(csv_file, delimiter=',', quotechar='"')
-        
-                            first_row= True
-                            for row in file_reader:
-                                if first_row:
-                                    first_row = False
-                                    continue   
-        
-                                cbgs = row[3]#[0:5]
-                                date_range_start = row[0][0:10]
-                                date_range_end = row[1][0:10]
-        
-                                constructed_output_id = date_range_start+"|"+date_range_end+"|"+cbgs
-        
-                                sample_size = int(row[4])
-        
-                                if constructed_output_id in cbg_week_samplesize_dict.keys():
-                                    cbg_week_samplesize_dict[constructed_output_id] =  cbg_week_samplesize_dict[constructed_output_id] + sample_size
-                                else:
-                                    cbg_week_samplesize_dict[constructed_output_id] =   sample_size
+        if isinstance(cbg_filter, str):
+            cbg_filter = [cbg_filter]
+        cbg_prefixes = tuple(cbg_filter) if cbg_filter else (county_FIP,)
+
+        if df_weekly_visits_avail==False:
+            self._extract_weekly_visits(base_filepath, POI_filepath, weekly_pattern_filepaths, path_to_save_weekly_patterns,
+                                        naics_codes, cbg_prefixes, demo_data, n_workers, verbose, incremental)
+
+        df_weekly_visits, df_home_cbgs = self._load_weekly_visits(POI_filepath, path_to_save_weekly_patterns, naics_codes,
+                                                                  (county_FIP,))
+        shapefiles = {'CBG': path_to_shapefile_CBG, 'CT': path_to_shapefile_CT}
+        centroid_indexes = {level: self.centroid_index(shapefiles[level], county_FIP, cache_filepath)
+                            for level in self._extraction_levels(extract_based_on)}
+        flows = self._county_week_flows(df_weekly_visits, df_home_cbgs, centroid_indexes, naics_names[0], date_range_end,
+                                        county_FIP, distance_mode)
+        for level, merged_flows in flows.items():
+            self._write_weekly_flows(merged_flows, path_to_save_weekly_flow_format, naics_names[0],
+                                     self._flow_outputs(kepler_format, outputs), output_format, output_chunksize, level)
+
+
+    def batch_weekly_visits(self, base_filepath, POI_filepath, weekly_pattern_filepaths, path_to_shapefile_CBG,
+                            path_to_shapefile_CT, path_to_save_weekly_patterns, path_to_save_weekly_flow_format,
+                            naics_codes, naics_names, date_range_ends, county_FIPs, df_weekly_visits_avail=True,
+                            extract_based_on='Census Tracts', kepler_format='Yes', demo_data=True, cbg_filter=None,
+                            n_workers=1, distance_mode='ellipsoidal', verbose=False, incremental=False, outputs=None,
+                            output_format='csv', output_chunksize=None, cache_filepath=None):
+        """
+        This function extracts the weekly flows of several weeks and counties in one run (see county_weekly_visits for the
+        arguments they share). The weekly patterns are scanned once for all the counties, and the weekly visits, POIs and
+        shapefile centroids are loaded once for all the (week, county) flow tables.
+
+        date_range_ends: list
+                    A list of end dates of the weeks interested in. Eg. ['2021-01-04', '2021-01-11']
+
+        county_FIPs: list
+                    A list of 5-digit string codes representing state and county. Eg. ['48201', '48157']
+
+        cbg_filter: list
+                    See county_weekly_visits. Defaults to county_FIPs.
+
+        cache_filepath: path
+                    See county_weekly_visits.
+
+        path_to_save_weekly_flow_format: path
+                    A directory to store the flows, partitioned by week and county: the files of a (week, county) flow table
+                    are stored as path_to_save_weekly_flow_format + 'date_range_end=<week>/county_FIP=<county>/weekly_flow' +
+                    the suffixes of county_weekly_visits (Eg. '-kepler-CT.csv').
+
+        Returns a dictionary of (date_range_end, county_FIP) -> path prefix of the stored flow table.
+        """
+        if isinstance(cbg_filter, str):
+            cbg_filter = [cbg_filter]
+        if isinstance(county_FIPs, str):
+            county_FIPs = [county_FIPs]
+        if isinstance(date_range_ends, str):
+            date_range_ends = [date_range_ends]
+        cbg_prefixes = tuple(cbg_filter) if cbg_filter else tuple(county_FIPs)
+
+        if df_weekly_visits_avail==False:
+            self._extract_weekly_visits(base_filepath, POI_filepath, weekly_pattern_filepaths, path_to_save_weekly_patterns,
+                                        naics_codes, cbg_prefixes, demo_data, n_workers, verbose, incremental)
+
+        df_weekly_visits, df_home_cbgs = self._load_weekly_visits(POI_filepath, path_to_save_weekly_patterns, naics_codes,
+                                                                  tuple(county_FIPs))
+        shapefiles = {'CBG': path_to_shapefile_CBG, 'CT': path_to_shapefile_CT}
+        centroid_indexes = {level: self.centroid_index(shapefiles[level], cache_filepath=cache_filepath)
+                            for level in self._extraction_levels(extract_based_on)}
+        flow_paths = {}
+        for date_range_end in date_range_ends:
+            for county_FIP in county_FIPs:
+                print(f"Extracting the weekly flows of county {county_FIP} for the week ending {date_range_end}")
+                flows = self._county_week_flows(df_weekly_visits, df_home_cbgs, centroid_indexes, naics_names[0],
+                                                date_range_end, county_FIP, distance_mode)
+                partition_path = os.path.join(path_to_save_weekly_flow_format, f'date_range_end={date_range_end}',
+                                              f'county_FIP={county_FIP}')
+                os.makedirs(partition_path, exist_ok=True)
+                flow_paths[(date_range_end, county_FIP)] = os.path.join(partition_path, 'weekly_flow')
+                for level, merged_flows in flows.items():
+                    self._write_weekly_flows(merged_flows, flow_paths[(date_range_end, county_FIP)], naics_names[0],
+                                             self._flow_outputs(kepler_format, outputs), output_format, output_chunksize,
+                                             level)
+        return flow_paths
+
+
+    def _extract_weekly_visits(self, base_filepath, POI_filepath, weekly_pattern_filepaths, path_to_save_weekly_patterns,
+                               naics_codes, cbg_prefixes, demo_data, n_workers=1, verbose=False, incremental=False):
+        """
+        This function aggregates the weekly patterns of the POIs of naics_codes whose poi_cbg starts with one of cbg_prefixes,
+        joins the home panel summary sample sizes and stores the weekly visits as path_to_save_weekly_patterns + '.csv',
+        along with their weekly visits cache (see _weekly_visits_cache_key). Nothing is done if the cache is up to date.
+        If incremental is True, only the files that the cache was not built from are aggregated and merged into it (see
+        _ingested_weekly_files).
+        """
+        # step 1: get the ids of specified POI outlets
+        # one combined lookup table of poi_id -> naics_code
+        poi_naics_dict = {}
+        for i in range(len(naics_codes)):
+            _store_ids = self.read_POIs(POI_filepath, naics_codes[i], columns=['safegraph_place_id'])['safegraph_place_id']
+            for _store_id in _store_ids.dropna():
+                poi_naics_dict.setdefault(_store_id, naics_codes[i])
+
+        # list the weekly patterns and home panel summary files and resolve their columns from their headers,
+        # so that a file of an unknown schema fails now rather than hours into the scan
+        pattern_file_paths = []
+        panel_file_paths = []
+        for path in weekly_pattern_filepaths:
+            weekly_pattern_files = sorted(os.listdir(base_filepath+'patterns/'+path))
+            for this_pattern_file in weekly_pattern_files:
+                if this_pattern_file.endswith(".csv.gz"):
+                    pattern_file_paths.append(base_filepath+'patterns/'+path+this_pattern_file)
+        # the demo data keeps all its home panel summary files in one directory
+        panel_paths = [''] if demo_data else weekly_pattern_filepaths
+        for path in panel_paths:
+            cbg_week_files = sorted(os.listdir(base_filepath+'home_panel_summary/'+path))
+            for cbg_week_samplesize_file in cbg_week_files:
+                if cbg_week_samplesize_file.endswith(".csv"):
+                    panel_file_paths.append(base_filepath+'home_panel_summary/'+path+cbg_week_samplesize_file)
+        pattern_columns = [self.resolve_schema(path, PATTERNS_SCHEMA) for path in pattern_file_paths]
+        panel_columns = [self.resolve_schema(path, HOME_PANEL_SCHEMA) for path in panel_file_paths]
+
+        cache_key = self._weekly_visits_cache_key(POI_filepath, naics_codes, cbg_prefixes, pattern_file_paths, panel_file_paths)
+        manifest = self._read_weekly_visits_manifest(path_to_save_weekly_patterns)
+        if manifest is not None and manifest.get('inputs') == cache_key:
+            print(f'The weekly visits in {path_to_save_weekly_patterns}.csv are up to date.')
+            return
+        ingested = self._ingested_weekly_files(path_to_save_weekly_patterns, manifest, cache_key) if incremental else None
+        if ingested is not None:
+            # only the weekly patterns and home panel summary files that are new since the last run are processed
+            ingested_pattern_paths, ingested_panel_paths = ingested
+            new_patterns = [i for i, path in enumerate(pattern_file_paths) if path not in ingested_pattern_paths]
+            new_panels = [i for i, path in enumerate(panel_file_paths) if path not in ingested_panel_paths]
+            pattern_file_paths = [pattern_file_paths[i] for i in new_patterns]
+            pattern_columns = [pattern_columns[i] for i in new_patterns]
+            panel_file_paths = [panel_file_paths[i] for i in new_panels]
+            panel_columns = [panel_columns[i] for i in new_panels]
+            print(f'Ingesting {len(pattern_file_paths)} new weekly patterns and {len(panel_file_paths)} new home panel summary files')
+
+        # step 2: go through the weekly patterns file
+        cbg_week_visits_dict, cbg_week_visitors_dict, home_cbg_week_visitors = self._aggregate_pattern_files(
+            pattern_file_paths, pattern_columns, poi_naics_dict, cbg_prefixes, n_workers)
     
+        print()
+        print()
+        print("DONE PROCESSING WEEKLY PATTERN FILES!!")
+        print()
+        print()
+        
+        # the county filter was applied to poi_cbg during the scan
+        county_keys = list(cbg_week_visits_dict.keys())
     
-            print()
-            print()
-            print("DONE PROCESSING HOME PANEL CSV FILES!!")
-            print()
-            print()
-            
-            # step 4: output the result to a file
-            filter_opt = [year for year in list(cbg_week_samplesize_dict.keys()) if ('|'+county_FIP in year)]
-            cbg_week_samplesize_dict_filtered = dictfilt(cbg_week_samplesize_dict, filter_opt)
-            output_file =  open(path_to_save_weekly_patterns+'.csv', 'w')
-            output_file_writer = csv.writer(output_file)
-            output_file_writer.writerow(["Census_Block_Groups","date_range_start","date_range_end","raw_visit_counts",
-                                         "raw_visitor_counts","visitor_home_cbgs","location_name","NAICS","samplesize"])
-                #output_file_list.append(output_file_writer)
-        
-        
-            for constructed_id in cbg_week_visits_dict_filtered.keys():
-                constructed_id_info = constructed_id.split("|")
-        
-                date_range_start = constructed_id_info[0]
-                date_range_end = constructed_id_info[1]
-                cbgs = constructed_id_info[2]
-                location_name = constructed_id_info[3]
-                naics_code = constructed_id_info[4]
-        
-                visits = cbg_week_visits_dict_filtered[constructed_id]
-                visitors = cbg_week_visitors_dict_filtered[constructed_id]
-                visitor_home_cbgs = home_cbg_week_visitors_dict_filtered[constructed_id]
-        
-                samplesize = cbg_week_samplesize_dict_filtered[date_range_start+"|"+date_range_end+"|"+cbgs]
-        
-                #for i in range(len(naics_code_range)):
-                #    if naics_code == naics_code_range[i]:
-                output_file_writer.writerow([cbgs,date_range_start,date_range_end,visits,visitors,visitor_home_cbgs,
-                                             location_name,naics_code,samplesize])
-        
-        
-            print(open(path_to_save_weekly_patterns+'.csv').read())
-            output_file.close()
-            print()
-            print()
-            print(f'Successfully extracted the weekly visits for {naics_codes[0]}!')
-    
-    
-        elif (df_weekly_visits_avail==False) & (demo_data==True):
-            # step 1: get the ids of specified POI outlets
-            movement_outlet_list = []
-            lat_list = []
-            lon_list = []
-            for i in range(len(naics_codes)):
-                _store_id_dict = {}
-                _lat_id_dict = {}
-                _lon_id_dict = {}
-                with open(POI_filepath+naics_codes[i]+'.csv', 'r') as csv_file:
-                    file_reader = csv.reader(csv_file, delimiter=',', quotechar='"')
-                    first_row= True
-                    for row in file_reader:
-                        if first_row:
-                            first_row = False
-                            continue   
-        
-                        _store_id = row[0]
-                        _store_id_dict[_store_id] = 0
-                        _lat_id = row[8] 
-                        _lat_id_dict[_lat_id] = 8
-                        _lon_id = row[9]
-                        _lon_id_dict[_lat_id] = 9
-        
-                movement_outlet_list.append(_store_id_dict)
-                lat_list.append(_lat_id_dict)
-                lon_list.append(_lon_id_dict)
-                
-            # step 2: go through the weekly patterns file
-            cbg_week_visits_dict = {}
-            cbg_week_visitors_dict = {}
-            home_cbg_week_visitors_dict = {}
-            for path in weekly_pattern_filepaths:
-                weekly_pattern_files = sorted(os.listdir(base_filepath+'patterns/'+path))
-                for this_pattern_file in weekly_pattern_files:
-                    if this_pattern_file.endswith(".csv.gz"):
-                        #print(path,this_pattern_file)
-                        input_pattern_file_path = base_filepath+'patterns/'+path+this_pattern_file
-                        print("Processing "+input_pattern_file_path)
-        
-                        with gzip.open(input_pattern_file_path, 'rt') as csv_file:
-                            file_reader = csv.reader(csv_file, delimiter=',', quotechar='"')
-                            first_row= True
-                            for row in file_reader:
-                                #print(row)
-                                if first_row:
-                                    first_row = False
-                                    continue
-        
-                                # if this POI is not a specified movement NAICS code in the specified region, continue
-                                poi_id = row[0]
-                                for i in range(len(naics_codes)):
-                                    if poi_id in movement_outlet_list[i].keys():
-                                        #print(poi_id)
-                                        poi_cbg = row[15]#[0:5]
-                                        date_range_start = row[9][0:10]
-                                        date_range_end = row[10][0:10]
-                                        naics_code = naics_codes[i]
-                                        location_name = row[1]
-        
-                                        visits = int(row[11])
-                                        visitors = int(row[12])
-                                        extracted_dict = eval(re.search(r"\{(.*?)\}", row[16]).group(0))
-        
-                                        constructed_output_id = date_range_start+"|"+date_range_end+"|"+poi_cbg+"|"+location_name+"|"+naics_code
-        
-                                        if constructed_output_id in cbg_week_visits_dict.keys():
-                                            cbg_week_visits_dict[constructed_output_id] =  cbg_week_visits_dict[constructed_output_id] + visits
-                                            cbg_week_visitors_dict[constructed_output_id] = cbg_week_visitors_dict[constructed_output_id] + visitors
-                                            home_cbg_week_visitors_dict[constructed_output_id] = self.add_dicts(home_cbg_week_visitors_dict[constructed_output_id],extracted_dict)
-                                        else:
-                                            cbg_week_visits_dict[constructed_output_id] =   visits
-                                            cbg_week_visitors_dict[constructed_output_id] =  visitors
-                                            home_cbg_week_visitors_dict[constructed_output_id] = extracted_dict
-        
-            print()
-            print()
-            print("DONE PROCESSING WEEKLY PATTERN FILES!!")
-            print()
-            print()
-            
-            ### Apply filter to select only specified county
-            dictfilt = lambda x, y: dict([ (i,x[i]) for i in x if i in set(y) ])
-            filter_opt = [year for year in list(cbg_week_visits_dict.keys()) if ('|'+county_FIP in year)]
-            cbg_week_visits_dict_filtered = dictfilt(cbg_week_visits_dict, filter_opt)
-            cbg_week_visitors_dict_filtered = dictfilt(cbg_week_visitors_dict, filter_opt)
-            home_cbg_week_visitors_dict_filtered = dictfilt(home_cbg_week_visitors_dict, filter_opt)
-        
-            # step 3: go through the sample size file
-            cbg_week_samplesize_dict = {}
-        
-            for path in weekly_pattern_filepaths:
-                cbg_week_files = sorted(os.listdir(base_filepath+'home_panel_summary/'))
-        
-                for cbg_week_samplesize_file in cbg_week_files:
-                    if cbg_week_samplesize_file.endswith(".csv"):
-                        input_panel_size_file_path = base_filepath+'home_panel_summary/'+cbg_week_samplesize_file
-                        print("Processing "+input_panel_size_file_path)
-        
-                        with open(input_panel_size_file_path, 'r') as csv_file:
-                            file_reader = csv.reader(csv_file, delimiter=',', quotechar='"')
-        
-                            first_row= True
-                            for row in file_reader:
-                                if first_row:
-                                    first_row = False
-                                    continue   
-        
-                                cbgs = row[3]#[0:5]
-                                date_range_start = row[0][0:10]
-                                date_range_end = row[1][0:10]
-        
-                                constructed_output_id = date_range_start+"|"+date_range_end+"|"+cbgs
-        
-                                sample_size = int(row[4])
-        
-                                if constructed_output_id in cbg_week_samplesize_dict.keys():
-                                    cbg_week_samplesize_dict[constructed_output_id] =  cbg_week_samplesize_dict[constructed_output_id] + sample_size
-                                else:
-                                    cbg_week_samplesize_dict[constructed_output_id] =   sample_size 
-        
-            
-            print()
-            print()
-            print("DONE PROCESSING HOME PANEL CSV FILES!!")
-            print()
-            print()
-            
-            # step 4: output the result to a file
-            filter_opt = [year for year in list(cbg_week_samplesize_dict.keys()) if ('|'+county_FIP in year)]
-            cbg_week_samplesize_dict_filtered = dictfilt(cbg_week_samplesize_dict, filter_opt)
-            output_file =  open(path_to_save_weekly_patterns+'.csv', 'w')
-            output_file_writer = csv.writer(output_file)
-            output_file_writer.writerow(["Census_Block_Groups","date_range_start","date_range_end","raw_visit_counts",
-                                         "raw_visitor_counts","visitor_home_cbgs","location_name","NAICS","samplesize"])
-                #output_file_list.append(output_file_writer)
-        
-        
-            for constructed_id in cbg_week_visits_dict_filtered.keys():
-                constructed_id_info = constructed_id.split("|")
-        
-                date_range_start = constructed_id_info[0]
-                date_range_end = constructed_id_info[1]
-                cbgs = constructed_id_info[2]
-                location_name = constructed_id_info[3]
-                naics_code = constructed_id_info[4]
-        
-                visits = cbg_week_visits_dict_filtered[constructed_id]
-                visitors = cbg_week_visitors_dict_filtered[constructed_id]
-                visitor_home_cbgs = home_cbg_week_visitors_dict_filtered[constructed_id]
-        
-                samplesize = cbg_week_samplesize_dict_filtered[date_range_start+"|"+date_range_end+"|"+cbgs]
-        
-                #for i in range(len(naics_code_range)):
-                #    if naics_code == naics_code_range[i]:
-                output_file_writer.writerow([cbgs,date_range_start,date_range_end,visits,visitors,visitor_home_cbgs,
-                                             location_name,naics_code,samplesize])
-        
-        
+        # step 3: go through the sample size file
+        df_samplesize = self.load_home_panel_summary(panel_file_paths, cbg_prefixes, panel_columns)
+    
+        print()
+        print()
+        print("DONE PROCESSING HOME PANEL CSV FILES!!")
+        print()
+        print()
+        
+        # step 4: output the result to a file
+        week_keys = ['date_range_start', 'date_range_end', 'Census_Block_Groups']
+        df_weekly_visits = pd.DataFrame(county_keys, columns=week_keys + ['safegraph_place_id', 'location_name', 'NAICS'])
+        df_weekly_visits['raw_visit_counts'] = [cbg_week_visits_dict[key] for key in county_keys]
+        df_weekly_visits['raw_visitor_counts'] = [cbg_week_visitors_dict[key] for key in county_keys]
+        df_weekly_visits['visitor_home_cbgs'] = [json.dumps(home_cbg_week_visitors.get(key)) for key in county_keys]
+        home_cbgs = self._home_cbgs_list_array(home_cbg_week_visitors.to_frame(county_keys), len(county_keys))
+        if ingested is not None:
+            df_weekly_visits, home_cbgs, df_samplesize = self._merge_weekly_visits_cache(
+                path_to_save_weekly_patterns, df_weekly_visits, home_cbgs, df_samplesize)
+        df_weekly_visits = df_weekly_visits.join(df_samplesize, on=week_keys)
+        df_weekly_visits['samplesize'] = df_weekly_visits['samplesize'].astype('Int64')
+        df_weekly_visits = df_weekly_visits[["Census_Block_Groups","date_range_start","date_range_end","raw_visit_counts",
+                                             "raw_visitor_counts","visitor_home_cbgs","safegraph_place_id","location_name",
+                                             "NAICS","samplesize"]]
+        df_weekly_visits.to_csv(path_to_save_weekly_patterns+'.csv', index=False)
+        self._write_weekly_visits_cache(df_weekly_visits, home_cbgs, df_samplesize, path_to_save_weekly_patterns, cache_key)
+    
+        if verbose:
             print(open(path_to_save_weekly_patterns+'.csv').read())
-            output_file.close()
             print()
             print()
-            print(f'Successfully extracted the weekly visits for {naics_codes[0]}!')
-    
-        
-        col_names = ['safegraph_place_id','parent_safegraph_place_id','location_name',
-                     'safegraph_brand_ids','brands','top_category','sub_category',
-                     'naics_code','latitude','longitude','street_address','city','region',
-                     'postal_code','iso_country_code','phone_number','open_hours','category_tags' ]
-        POIs_df = pd.read_csv(POI_filepath+naics_codes[0]+'.csv',names=col_names)
-        POIs_df = POIs_df.drop(0)
-        POIs_df = POIs_df.set_index(POIs_df['safegraph_place_id'])
-        del POIs_df['safegraph_place_id']
-        POIs_df = POIs_df.reset_index()
-    
-    
-        df_county_visits = pd.read_csv(path_to_save_weekly_patterns+'.csv')
-        df_county_visits = df_county_visits.sort_values(by=['Census_Block_Groups', 'date_range_start', 'date_range_end'])
-        
-        ##### Merge weekly_visit and POI dataframes based on the 'location name' column
-        # Placeholder for the new columns
-        df_county_visits['longitude'] = None
-        df_county_visits['latitude'] = None
-        
-        # Iterate over the rows of the df_county_visits dataframe
-        for index, row in df_county_visits.iterrows():
-            # Find the matching row in the main dataframe
-            matching_row = POIs_df[(POIs_df['location_name'] == row['location_name'])]
-        
-            # If there is a match, update the coordinates in df_hc_visits
-            if not matching_row.empty:
-                df_county_visits.at[index, 'longitude'] = matching_row.iloc[0]['longitude']
-                df_county_visits.at[index, 'latitude'] = matching_row.iloc[0]['latitude']
-        
-        # df_county_visits now contains the additional columns from POIs_df where the longitude and latitude values match
-        df_county_visits = df_county_visits.reset_index()
-        del df_county_visits['index']
-    
-        _state_cb = gp.read_file(path_to_shapefile_CBG)
-        _state_cb = _state_cb[['STATEFP', 'COUNTYFP', 'TRACTCE', 'BLKGRPCE', 'GEOID', 'geometry']]
-        _state_cb['LON'] = _state_cb['geometry'].centroid.x
-        _state_cb['LAT'] = _state_cb['geometry'].centroid.y
-        _county_CBG = _state_cb[_state_cb.COUNTYFP.values==county_FIP[2:]]
-    
-        week_ = df_county_visits[df_county_visits['date_range_end'] == date_range_end]
-        week_home_cbg_list = []
-        for i in np.arange(0,len(week_['visitor_home_cbgs'])):
-            week_home_cbg_list.append(eval(re.search(r"\{(.*?)\}", week_['visitor_home_cbgs'].reset_index(drop=True)[i]).group(0)))
+        print(f'Successfully extracted the weekly visits for {naics_codes[0]}!')
+
+
+    def _weekly_visits_cache_key(self, POI_filepath, naics_codes, cbg_prefixes, pattern_file_paths, panel_file_paths):
+        """
+        This function returns the inputs a weekly visits extraction depends on: the NAICS codes and CBG prefixes, and the
+        [path, size, modification time] of the extracted POI files, weekly patterns and home panel summary files.
+        """
+        POI_file_paths = []
+        for naics_code in naics_codes:
+            parquet_path = POI_filepath + naics_code + '.parquet'
+            if os.path.isdir(parquet_path):
+                POI_file_paths += sorted(os.path.join(root, file_name) for root, _, file_names in os.walk(parquet_path)
+                                         for file_name in file_names)
+            else:
+                POI_file_paths.append(POI_filepath + naics_code + '.csv')
+        return {'naics_codes': list(naics_codes), 'cbg_prefixes': list(cbg_prefixes),
+                'POIs': self._file_fingerprints(POI_file_paths), 'patterns': self._file_fingerprints(pattern_file_paths),
+                'home_panel_summary': self._file_fingerprints(panel_file_paths)}
+
+
+    def _read_weekly_visits_manifest(self, path_to_save_weekly_patterns):
+        """
+        This function returns the manifest of the weekly visits cache (path_to_save_weekly_patterns + '.cache/') if the cache
+        is consistent with the weekly visits csv file, and None otherwise.
+        """
+        csv_path = path_to_save_weekly_patterns + '.csv'
+        if not os.path.exists(csv_path):
+            return None
+        return self._current_manifest(path_to_save_weekly_patterns + '.cache', self._file_fingerprints([csv_path]), 'csv')
+
+
+    def _ingested_weekly_files(self, path_to_save_weekly_patterns, manifest, cache_key):
+        """
+        This function returns the (weekly patterns paths, home panel summary paths) the weekly visits cache was built from, if
+        new files can be merged into it: the cache was built for the same NAICS codes, CBG prefixes and POI files, and none of
+        the files it was built from has been changed or removed since. Returns None otherwise (the weekly visits are rebuilt).
+        """
+        if manifest is None or not os.path.exists(os.path.join(path_to_save_weekly_patterns + '.cache',
+                                                               'home_panel_summary.parquet')):
+            return None
+        inputs = manifest['inputs']
+        if any(inputs.get(field) != cache_key[field] for field in ['naics_codes', 'cbg_prefixes', 'POIs']):
+            return None
+        ingested = []
+        for field in ['patterns', 'home_panel_summary']:
+            fingerprints = {tuple(fingerprint) for fingerprint in cache_key[field]}
+            if not all(tuple(fingerprint) in fingerprints for fingerprint in inputs[field]):
+                print(f'An ingested {field} file has changed or was removed: rebuilding the weekly visits.')
+                return None
+            ingested.append({path for path, _, _ in inputs[field]})
+        return tuple(ingested)
+
+
+    def _merge_weekly_visits_cache(self, path_to_save_weekly_patterns, df_new_visits, new_home_cbgs, df_new_samplesize):
+        """
+        This function merges the weekly visits aggregated from new files (without samplesize) and their home CBGs (see
+        _home_cbgs_list_array) into the cached weekly visits, and the new home panel summary sample sizes into the cached
+        ones. New rows are appended after the cached rows; rows of a key that is already cached (a week whose files arrived
+        over several runs) are added to the cached row. Returns the merged (weekly visits, home CBGs, samplesize).
+        """
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        cache_path = path_to_save_weekly_patterns + '.cache'
+        week_keys = ['date_range_start', 'date_range_end', 'Census_Block_Groups']
+        key_columns = week_keys + ['safegraph_place_id', 'location_name', 'NAICS']
+        table = pq.read_table(os.path.join(cache_path, 'weekly_visits.parquet'))
+        home_cbgs = table.column('visitor_home_cbgs').combine_chunks()
+        df_weekly_visits = table.drop_columns(['visitor_home_cbgs', 'samplesize']).to_pandas()
+        # the visitor_home_cbgs text of the cached rows is kept as written
+        df_weekly_visits['visitor_home_cbgs'] = pd.read_csv(path_to_save_weekly_patterns + '.csv', usecols=['visitor_home_cbgs'],
+                                                            dtype=str, keep_default_na=False)['visitor_home_cbgs'].values
+
+        cached_rows = pd.MultiIndex.from_frame(df_weekly_visits[key_columns].astype(str)).get_indexer(
+            pd.MultiIndex.from_frame(df_new_visits[key_columns].astype(str)))
+        if (cached_rows >= 0).any():
+            # the home CBGs of the cached and new rows are accumulated by their row in the merged weekly visits
+            new_rows = cached_rows < 0
+            merged_rows = np.where(new_rows, len(df_weekly_visits) + np.cumsum(new_rows) - 1, cached_rows)
+            home_cbg_visitors = ODAccumulator()
+            for row, row_home_cbgs in enumerate(home_cbgs.to_pylist()):
+                home_cbg_visitors.add_pairs(row, [(home_cbg['GEOID'], home_cbg['visitor_count']) for home_cbg in row_home_cbgs])
+            for new_row, row_home_cbgs in enumerate(new_home_cbgs.to_pylist()):
+                merged_row = int(merged_rows[new_row])
+                home_cbg_visitors.add_pairs(merged_row, [(home_cbg['GEOID'], home_cbg['visitor_count'])
+                                                         for home_cbg in row_home_cbgs])
+                if new_rows[new_row]:
+                    continue
+                for column in ['raw_visit_counts', 'raw_visitor_counts']:
+                    df_weekly_visits.iloc[merged_row, df_weekly_visits.columns.get_loc(column)] += df_new_visits[column].iloc[new_row]
+                df_weekly_visits.iloc[merged_row, df_weekly_visits.columns.get_loc('visitor_home_cbgs')] = json.dumps(
+                    home_cbg_visitors.get(merged_row))
+            n_rows = len(df_weekly_visits) + int(new_rows.sum())
+            home_cbgs = self._home_cbgs_list_array(home_cbg_visitors.to_frame(range(n_rows)), n_rows)
+            df_new_visits = df_new_visits[new_rows]
+        else:
+            home_cbgs = pa.concat_arrays([home_cbgs, new_home_cbgs])
+        df_weekly_visits = pd.concat([df_weekly_visits, df_new_visits[df_weekly_visits.columns]], ignore_index=True)
+
+        df_samplesize = pd.read_parquet(os.path.join(cache_path, 'home_panel_summary.parquet'))
+        df_samplesize = (pd.concat([df_samplesize, df_new_samplesize.reset_index()], ignore_index=True)
+                         .groupby(week_keys, sort=False)[['samplesize']].sum())
+        return df_weekly_visits, home_cbgs, df_samplesize
+
+
+    def _home_cbgs_list_array(self, od_records, n_rows):
+        """
+        This function converts the long format home CBG records of n_rows weekly visits rows (the (_row, GEOID, Visitor_Count)
+        dataframe of ODAccumulator.to_frame, ordered by _row) into an arrow list array of (GEOID, visitor_count) structs,
+        one list per row.
+        """
+        import pyarrow as pa
+        offsets = np.zeros(n_rows + 1, dtype='int32')
+        np.cumsum(np.bincount(od_records['_row'].values, minlength=n_rows), out=offsets[1:])
+        home_cbgs = pa.StructArray.from_arrays(
+            [pa.array(od_records['GEOID'].values, type=pa.string()),
+             pa.array(od_records['Visitor_Count'].values, type=pa.int64())],
+            names=['GEOID', 'visitor_count'])
+        return pa.ListArray.from_arrays(pa.array(offsets), home_cbgs)
+
+
+    def _write_weekly_visits_cache(self, df_weekly_visits, home_cbgs, df_samplesize, path_to_save_weekly_patterns, cache_key):
+        """
+        This function stores the weekly visits as a typed parquet file (path_to_save_weekly_patterns +
+        '.cache/weekly_visits.parquet'), with visitor_home_cbgs kept as a list of (GEOID, visitor_count) structs (home_cbgs,
+        see _home_cbgs_list_array) rather than text, so that later runs load them without parsing, and the home panel summary
+        sample sizes they were joined with (home_panel_summary.parquet). The manifest (inputs and csv fingerprint) is
+        written last.
+        """
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        cache_path = path_to_save_weekly_patterns + '.cache'
+        self._reset_cache(cache_path)
+
+        df_typed = df_weekly_visits.drop(columns=['visitor_home_cbgs']).astype(
+            {'Census_Block_Groups': 'string', 'date_range_start': 'string', 'date_range_end': 'string',
+             'safegraph_place_id': 'string', 'location_name': 'string', 'NAICS': 'string'})
+        table = pa.Table.from_pandas(df_typed, preserve_index=False)
+        table = table.append_column('visitor_home_cbgs', home_cbgs)
+        pq.write_table(table, os.path.join(cache_path, 'weekly_visits.parquet'))
+        df_samplesize.reset_index().astype({'date_range_start': 'string', 'date_range_end': 'string',
+                                            'Census_Block_Groups': 'string', 'samplesize': 'int64'}).to_parquet(
+            os.path.join(cache_path, 'home_panel_summary.parquet'), index=False)
+
+        self._write_manifest(cache_path, {'inputs': cache_key,
+                                          'csv': self._file_fingerprints([path_to_save_weekly_patterns + '.csv'])})
+
+
+    def _load_weekly_visits(self, POI_filepath, path_to_save_weekly_patterns, naics_codes, cbg_prefixes):
+        """
+        This function reads the stored weekly visits (see _extract_weekly_visits) with the longitude and latitude of each POI,
+        from their cache if it is consistent with the csv file and from the csv file otherwise. Returns the weekly visits
+        (without visitor_home_cbgs) and their home CBGs exploded into (_row, GEOID, Visitor_Count) records, where _row is the
+        position of the weekly visits row, keeping only the home CBGs that start with one of cbg_prefixes.
+        """
+        POIs_df = self.read_POIs(POI_filepath, naics_codes[0], columns=['safegraph_place_id', 'location_name',
+                                                                         'latitude', 'longitude'])
+        if self._read_weekly_visits_manifest(path_to_save_weekly_patterns) is not None:
+            import pyarrow.compute as pc
+            import pyarrow.parquet as pq
+            table = pq.read_table(os.path.join(path_to_save_weekly_patterns + '.cache', 'weekly_visits.parquet'))
+            home_cbgs = table.column('visitor_home_cbgs').combine_chunks()
+            home_cbg_values = pc.list_flatten(home_cbgs)
+            geoids = home_cbg_values.field('GEOID')
+            prefix_mask = pc.starts_with(geoids, cbg_prefixes[0])
+            for cbg_prefix in cbg_prefixes[1:]:
+                prefix_mask = pc.or_(prefix_mask, pc.starts_with(geoids, cbg_prefix))
+            df_home_cbgs = pd.DataFrame({'_row': pc.list_parent_indices(home_cbgs).filter(prefix_mask).to_numpy(),
+                                         'GEOID': geoids.filter(prefix_mask).to_numpy(zero_copy_only=False).astype(str),
+                                         'Visitor_Count': home_cbg_values.field('visitor_count').filter(prefix_mask).to_numpy()})
+            df_weekly_visits = table.drop_columns(['visitor_home_cbgs']).to_pandas()
+        else:
+            # weekly visits csv files without a cache (Eg. written by earlier versions) are parsed
+            df_weekly_visits = pd.read_csv(path_to_save_weekly_patterns+'.csv', dtype={'safegraph_place_id': str})
+            rows, home_cbgs, visitor_counts = parse_home_cbgs_arrays(df_weekly_visits['visitor_home_cbgs'], tuple(cbg_prefixes))
+            df_home_cbgs = pd.DataFrame({'_row': rows, 'GEOID': home_cbgs.astype(str), 'Visitor_Count': visitor_counts})
+            df_weekly_visits = df_weekly_visits.drop(columns=['visitor_home_cbgs'])
+        
+        ##### Merge weekly_visit and POI dataframes based on the 'safegraph_place_id' column
+        # weekly visits files written before the place id was carried through the aggregation fall back to the
+        # first POI of the same location_name
+        poi_key = 'safegraph_place_id' if 'safegraph_place_id' in df_weekly_visits.columns else 'location_name'
+        POI_coordinates = POIs_df.drop_duplicates(poi_key).set_index(poi_key)[['longitude', 'latitude']]
+        df_weekly_visits = df_weekly_visits.join(POI_coordinates, on=poi_key).reset_index(drop=True)
+        df_weekly_visits['Census_Block_Groups'] = df_weekly_visits['Census_Block_Groups'].astype(str)
+        return df_weekly_visits, df_home_cbgs
+
+
+    def _county_week_flows(self, df_weekly_visits, df_home_cbgs, centroid_indexes, naics_name, date_range_end, county_FIP,
+                           distance_mode='ellipsoidal'):
+        """
+        This function returns the flow tables (home unit -> destination unit visitor counts, centroids and Distance_Covered
+        (km)) of one week and county, from the weekly visits and home CBGs of _load_weekly_visits, at every resolution of
+        centroid_indexes (a dictionary of FLOW_LEVELS level -> centroid index, see centroid_index). The CBG origin-destination
+        aggregate is built once and rolled up to tracts. Returns a dictionary of level -> flow table.
+        """
+        week_ = df_weekly_visits[(df_weekly_visits['date_range_end'] == date_range_end) &
+                                 df_weekly_visits['Census_Block_Groups'].str.startswith(county_FIP)]
+        #### (destination CBG, home CBG, visitor count) records of the week, with visitor/home CBGs in specified county only
+        week_home_cbgs = df_home_cbgs.join(week_[['Census_Block_Groups', 'date_range_start', 'date_range_end']], on='_row',
+                                           how='inner')
+        week_home_cbgs = week_home_cbgs[week_home_cbgs['GEOID'].str.startswith(county_FIP)]
         print('Done')
-        week_temp = pd.DataFrame({naics_names[0]+'_CBG': week_['Census_Block_Groups'].tolist(), 'home_cbg_dict': week_home_cbg_list,
-                                  naics_names[0]+'_LON': week_['longitude'].tolist(), naics_names[0]+'_LAT': week_['latitude'].tolist(),
-                                  'date_range_start':week_['date_range_start'].tolist(), 'date_range_end':week_['date_range_end'].tolist()
-                                 })
-        print('Next')
-        
-        week_new_df = (pd.DataFrame(week_temp['home_cbg_dict'].tolist(), index=week_temp[[naics_names[0]+'_CBG',
-                                                                                          naics_names[0]+'_LON', 
-                                                                                          naics_names[0]+'_LAT',
-                                                                                          'date_range_start',
-                                                                                          'date_range_end']])
-                    .reset_index()
-                    .melt('index', var_name='GEOID', value_name='Visitor_Count')
-                    .dropna()
-                    .reset_index(drop=True))
-        
-        week_new_df_final = pd.DataFrame(week_new_df['index'].tolist(), columns=[naics_names[0]+'_CBG',naics_names[0]+'_LON',
-                                                                                 naics_names[0]+'_LAT','date_range_start',
-                                                                                          'date_range_end'])
-        week_new_df_final['GEOID'] = week_new_df ['GEOID']
-        week_new_df_final['Visitor_Count'] = week_new_df ['Visitor_Count']
-        
-        #### select visitor/home CBGs in specified county only
-        county_home_CBGs = week_new_df_final[week_new_df_final['GEOID'].str.match(county_FIP)]
-    
-    
-        #### Based on Census Tracts:
-        _state_ct = gp.read_file(path_to_shapefile_CT)
-    
-        _state_ct = _state_ct[['STATEFP', 'COUNTYFP', 'TRACTCE', 'GEOID', 'geometry']]
-        _state_ct['LON'] = _state_ct['geometry'].centroid.x
-        _state_ct['LAT'] = _state_ct['geometry'].centroid.y
-        _county_CT = _state_ct[_state_ct.COUNTYFP.values==county_FIP[2:]]
-    
-        county_home_CBGs[naics_names[0]+'_CBG'] = county_home_CBGs[naics_names[0]+'_CBG'].values.astype(str)
-        
-        county_CTs = county_home_CBGs.groupby([county_home_CBGs[naics_names[0]+'_CBG'].str[5:11],'date_range_start',
-               'date_range_end', county_home_CBGs['GEOID'].str[5:11]])['Visitor_Count'].sum().reset_index(name='Tot. Visitor_count')
-        home_county_CTs = county_CTs.copy()
-        home_county_CTs.columns = [naics_names[0]+'_TRACTCE','date_range_start','date_range_end','TRACTCE', 'Visitor_Count']
-    
-        #### Merge 
-        merged_on_home_CTS = home_county_CTs.copy()
-        # Placeholder for the new columns
-        merged_on_home_CTS['STATEFP'] = None
-        merged_on_home_CTS['COUNTYFP'] = None
-        merged_on_home_CTS['Home_LON'] = None
-        merged_on_home_CTS['Home_LAT'] = None
-        
-        # Iterate over the rows of the merged_on_home_CTS dataframe
-        for index, row in merged_on_home_CTS.iterrows():
-            # Find the matching row in the main dataframe
-            matching_row = _county_CT[(_county_CT['TRACTCE'] == row['TRACTCE'])]
-        
-            # If there is a match, update the coordinates in merged_on_home_CTS
-            if not matching_row.empty:
-                merged_on_home_CTS.at[index, 'Home_LON'] = matching_row.iloc[0]['LON']
-                merged_on_home_CTS.at[index, 'Home_LAT'] = matching_row.iloc[0]['LAT']
-                merged_on_home_CTS.at[index, 'STATEFP'] = matching_row.iloc[0]['STATEFP']
-                merged_on_home_CTS.at[index, 'COUNTYFP'] = matching_row.iloc[0]['COUNTYFP']
-        
-        # merged_on_home_CTS now contains the additional columns from _county_CT where the TRACTCE values match
-        
-        merged_on_home_CTS.columns = ['TRACTCE', 'date_range_start', 'date_range_end', 'Home_TRACTCE',
-                                      'Visitor_count', 'STATEFP', 'COUNTYFP', 'Home_LON', 'Home_LAT']
-        
-        merged_on_NAICS_CTS = merged_on_home_CTS.copy()
-        # Placeholder for the new columns
-        merged_on_NAICS_CTS[naics_names[0]+'_LON'] = None
-        merged_on_NAICS_CTS[naics_names[0]+'_LAT'] = None
-        
-        # Iterate over the rows of the merged_on_NAICS_CTS dataframe
-        for index, row in merged_on_NAICS_CTS.iterrows():
-            # Find the matching row in the main dataframe
-            matching_row = _county_CT[(_county_CT['TRACTCE'] == row['TRACTCE'])]
-        
-            # If there is a match, update the coordinates in merged_on_NAICS_CTS
-            if not matching_row.empty:
-                merged_on_NAICS_CTS.at[index, naics_names[0]+'_LON'] = matching_row.iloc[0]['LON']
-                merged_on_NAICS_CTS.at[index, naics_names[0]+'_LAT'] = matching_row.iloc[0]['LAT']
-                
-        # merged_on_NAICS_CTS now contains the additional columns from _county_CT where the GEOID values match
-        
-        merged_on_NAICS_CTS.columns = [naics_names[0]+'_TRACTCE', 'date_range_start', 'date_range_end', 'Home_TRACTCE',
-                                      'Visitor_Count', 'STATEFP', 'COUNTYFP', 'Home_LON', 'Home_LAT',naics_names[0]+'_LON',
-                                       naics_names[0]+'_LAT']
-        
-        merged_on_NAICS_CTS = merged_on_NAICS_CTS[['date_range_start','date_range_end',naics_names[0]+'_TRACTCE','Home_TRACTCE','STATEFP',
-                                                'COUNTYFP','Visitor_Count','Home_LON','Home_LAT',naics_names[0]+'_LON',naics_names[0]+'_LAT']]
-        merged_on_NAICS_CTS = merged_on_NAICS_CTS.dropna().reset_index()
-        del merged_on_NAICS_CTS['index']
-    
-        ####offset naics_CBGS lon and lat:
-        merged_on_NAICS_CTS[naics_names[0]+'_LON'] = merged_on_NAICS_CTS[naics_names[0]+'_LON']+0.02
-        merged_on_NAICS_CTS[naics_names[0]+'_LAT'] = merged_on_NAICS_CTS[naics_names[0]+'_LAT']+0.02
-        
-        dist_array = []
-        for i in range(0,len(merged_on_NAICS_CTS)):
-            dist = geodesic(merged_on_NAICS_CTS[['Home_LAT','Home_LON']].values[i],
-                            merged_on_NAICS_CTS[[naics_names[0]+'_LAT',naics_names[0]+'_LON']].values[i]).km
-            dist_array.append(dist)
-    
-        merged_on_NAICS_CTS['Distance_Covered (km)']=dist_array
-        
-        if kepler_format == 'Yes':
-            week_kepler_CT = merged_on_NAICS_CTS[[naics_names[0]+'_LON',naics_names[0]+'_LAT','Home_LON', 'Visitor_Count', 'Home_LAT']]
-            week_kepler_CT.to_csv(path_to_save_weekly_flow_format+'-kepler-CT.csv',encoding="UTF-8", index=False)
+        county_home_CBGs = pd.DataFrame({naics_name+'_GEOID': week_home_cbgs['Census_Block_Groups'].values,
+                                         'date_range_start': week_home_cbgs['date_range_start'].values,
+                                         'date_range_end': week_home_cbgs['date_range_end'].values,
+                                         'Home_GEOID': week_home_cbgs['GEOID'].values,
+                                         # float counts, as written by earlier versions
+                                         'Visitor_Count': week_home_cbgs['Visitor_Count'].values.astype('float64')})
+
+        #### origin-destination aggregate, from CBGs (12-digit GEOIDs) rolled up to tracts (the first 11 digits)
+        flows = {}
+        od_flows = county_home_CBGs
+        for level in sorted(FLOW_LEVELS, key=lambda level: -FLOW_LEVELS[level][0]):
+            geoid_digits = FLOW_LEVELS[level][0]
+            od_flows = od_flows.groupby([od_flows[naics_name+'_GEOID'].str[:geoid_digits], 'date_range_start', 'date_range_end',
+                                         od_flows['Home_GEOID'].str[:geoid_digits]])['Visitor_Count'].sum().reset_index()
+            if level in centroid_indexes:
+                flows[level] = self._level_flows(od_flows, centroid_indexes[level], naics_name, level, county_FIP,
+                                                 distance_mode)
+        return flows
+
+
+    def _level_flows(self, od_flows, _centroid_index, naics_name, level, county_FIP, distance_mode='ellipsoidal'):
+        """
+        This function attaches the home and destination centroids of a FLOW_LEVELS level to an origin-destination aggregate
+        (<naics_name>_GEOID, date_range_start, date_range_end, Home_GEOID, Visitor_Count) of that level and computes the
+        Distance_Covered (km). Pairs of units missing from the centroid index are dropped.
+        """
+        unit_column = FLOW_LEVELS[level][1]
+        unit_suffix = '_' + (unit_column or level)
+        _county_index = _centroid_index[_centroid_index.index.str.startswith(county_FIP)]
+        units = _county_index[unit_column].values if unit_column else _county_index.index.values
+
+        #### Merge the home and NAICS centroids on their GEOIDs
+        home_units = pd.DataFrame({'Home'+unit_suffix: units, 'STATEFP': _county_index['STATEFP'].values,
+                                   'COUNTYFP': _county_index['COUNTYFP'].values, 'Home_LON': _county_index['LON'].values,
+                                   'Home_LAT': _county_index['LAT'].values}, index=_county_index.index)
+        naics_units = pd.DataFrame({naics_name+unit_suffix: units, naics_name+'_LON': _county_index['LON'].values,
+                                    naics_name+'_LAT': _county_index['LAT'].values}, index=_county_index.index)
+        merged_flows = od_flows.join(home_units, on='Home_GEOID').join(naics_units, on=naics_name+'_GEOID')
+        
+        merged_flows = merged_flows[['date_range_start','date_range_end',naics_name+unit_suffix,'Home'+unit_suffix,'STATEFP',
+                                     'COUNTYFP','Visitor_Count','Home_LON','Home_LAT',naics_name+'_LON',naics_name+'_LAT']]
+        merged_flows = merged_flows.dropna().reset_index(drop=True)
     
-        else:
-            merged_on_NAICS_CTS.to_csv(path_to_save_weekly_flow_format+'-CT.csv',encoding="UTF-8", index=False)
-            network_analysis_CT = merged_on_NAICS_CTS[[naics_names[0]+'_TRACTCE', 'Home_TRACTCE', 'Visitor_Count',
-                                                       naics_names[0]+'_LON',naics_names[0]+'_LAT','Home_LON', 'Home_LAT',
-                                                       'Distance_Covered (km)']]
-            network_analysis_CT.to_csv(path_to_save_weekly_flow_format+'-network_analysis-CT.csv',encoding="UTF-8", index=False)
+        ####offset naics lon and lat:
+        merged_flows[naics_name+'_LON'] = merged_flows[naics_name+'_LON']+0.02
+        merged_flows[naics_name+'_LAT'] = merged_flows[naics_name+'_LAT']+0.02
+        
+        merged_flows['Distance_Covered (km)'] = distance_km(merged_flows['Home_LAT'], merged_flows['Home_LON'],
+                                                            merged_flows[naics_name+'_LAT'], merged_flows[naics_name+'_LON'],
+                                                            mode=distance_mode)
+        return merged_flows
+
 
+    def _flow_outputs(self, kepler_format, outputs=None):
+        """
+        This function returns the flow outputs to write: outputs if given (checked against FLOW_OUTPUTS), and otherwise
+        ['kepler'] if kepler_format is 'Yes' and ['full', 'network_analysis'] if not.
+        """
+        if outputs is None:
+            return ['kepler'] if kepler_format == 'Yes' else ['full', 'network_analysis']
+        unknown_outputs = [output for output in outputs if output not in FLOW_OUTPUTS]
+        if unknown_outputs:
+            raise ValueError(f"Unknown flow outputs {unknown_outputs}: choose from {FLOW_OUTPUTS}")
+        return list(outputs)
 
 
-    def POI_Census_Tract_count(self, poi_df, path_to_shapefile_CT, naics_name):
+    def _extraction_levels(self, extract_based_on):
+        """
+        This function returns the FLOW_LEVELS levels of an extract_based_on value ('CBGs', 'Census Tracts' or 'both').
+        """
+        if extract_based_on not in EXTRACT_BASED_ON_LEVELS:
+            raise ValueError(f"extract_based_on must be one of {list(EXTRACT_BASED_ON_LEVELS)}")
+        return EXTRACT_BASED_ON_LEVELS[extract_based_on]
+
+
+    def _write_weekly_flows(self, merged_on_NAICS_CTS, path_to_flows, naics_name, outputs, output_format='csv',
+                            output_chunksize=None, level='CT'):
+        """
+        This function stores a flow table of a FLOW_LEVELS level (see _county_week_flows) in every output of outputs in one
+        pass over the table, output_chunksize (default FLOW_WRITE_CHUNK_ROWS) rows at a time:
+        'kepler' as path_to_flows + '-kepler-<level>', 'full' (all columns) as path_to_flows + '-<level>' and
+        'network_analysis' as path_to_flows + '-network_analysis-<level>', each with the extension of output_format ('csv',
+        'csv.gz' or 'parquet').
+        """
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        if output_format not in FLOW_OUTPUT_FORMATS:
+            raise ValueError(f"output_format must be one of {list(FLOW_OUTPUT_FORMATS)}")
+        unit_suffix = '_' + (FLOW_LEVELS[level][1] or level)
+        output_columns = {'kepler': [naics_name+'_LON',naics_name+'_LAT','Home_LON', 'Visitor_Count', 'Home_LAT'],
+                          'full': list(merged_on_NAICS_CTS.columns),
+                          'network_analysis': [naics_name+unit_suffix, 'Home'+unit_suffix, 'Visitor_Count',
+                                               naics_name+'_LON',naics_name+'_LAT','Home_LON', 'Home_LAT',
+                                               'Distance_Covered (km)']}
+        output_suffixes = {'kepler': '-kepler-'+level, 'full': '-'+level, 'network_analysis': '-network_analysis-'+level}
+        output_chunksize = output_chunksize or FLOW_WRITE_CHUNK_ROWS
+
+        sinks = {}
+        try:
+            for output in outputs:
+                output_path = path_to_flows + output_suffixes[output] + FLOW_OUTPUT_FORMATS[output_format]
+                if output_format == 'csv':
+                    sinks[output] = open(output_path, 'w', encoding='UTF-8', newline='')
+                elif output_format == 'csv.gz':
+                    sinks[output] = gzip.open(output_path, 'wt', encoding='UTF-8', newline='')
+                else:
+                    schema = pa.Schema.from_pandas(merged_on_NAICS_CTS[output_columns[output]].iloc[:output_chunksize],
+                                                   preserve_index=False)
+                    # text columns of object dtype have no arrow type while they are empty or missing: they are stored as strings
+                    schema = pa.schema([field.with_type(pa.string()) if pa.types.is_null(field.type) else field
+                                        for field in schema], metadata=schema.metadata)
+                    sinks[output] = pq.ParquetWriter(output_path, schema)
+
+            # the header (or empty table) is written with the first chunk, even if the flow table is empty
+            for chunk_start in range(0, max(len(merged_on_NAICS_CTS), 1), output_chunksize):
+                chunk = merged_on_NAICS_CTS.iloc[chunk_start:chunk_start + output_chunksize]
+                for output, sink in sinks.items():
+                    if output_format == 'parquet':
+                        sink.write_table(pa.Table.from_pandas(chunk[output_columns[output]], schema=sink.schema,
+                                                              preserve_index=False))
+                    else:
+                        chunk.to_csv(sink, columns=output_columns[output], header=(chunk_start == 0), index=False)
+        finally:
+            for sink in sinks.values():
+                sink.close()
+
+
+
+    def POI_Census_Tract_count(self, poi_df, path_to_shapefile_CT, naics_name, cache_filepath=None):
         """
         This function returns a two column dataframe of Census Tract and number of POIs in each Tract
 
@@ -862,6 +1712,9 @@ class Extract:
 
         naics_name: str
                 A string of name of the NAICS code representing the business to extract the number of counts for each census tract. Eg: 'EducatioN POIs'.
+
+        cache_filepath: path
+                A directory to store the geometry cache of the shapefile (see geometry_cache). Defaults to the directory of the shapefile.
     
         """
         from shapely.geometry import Point
@@ -870,20 +1723,37 @@ class Extract:
         geometry = [Point(xy) for xy in zip(poi_df['longitude'].astype(float), poi_df['latitude'].astype(float))]
         gdf_pois = gp.GeoDataFrame(poi_df, geometry=geometry)
     
-        # Load the census tracts shapefile (this should be replaced with the actual path to the shapefile)
-        census_tracts = gp.read_file(path_to_shapefile_CT)
+        # Load the census tracts through their geometry cache
+        census_tracts = self.read_geometries(path_to_shapefile_CT, cache_filepath=cache_filepath)
     
         #use the same coordinate reference system (CRS) for both GeoDataFrames
         gdf_pois = gdf_pois.set_crs(census_tracts.crs, allow_override=True)
     
         # Perform the spatial join
-        joined_gdf = gp.sjoin(gdf_pois, census_tracts, how='left', op='within')
+        joined_gdf = gp.sjoin(gdf_pois, census_tracts, how='left', predicate='within')
     
         # Count the number of POIs in each census tract
         tract_poi_counts = joined_gdf.groupby('TRACTCE').size().reset_index(name='Number of '+naics_name)
         return tract_poi_counts
 
 
+_pattern_worker_args = {}
+
+
+def _init_pattern_worker(poi_naics_dict, cbg_prefixes):
+    """
+    This function stores the arguments shared by every task of a weekly patterns process pool worker (see county_weekly_visits).
+    """
+    _pattern_worker_args.update(poi_naics_dict=poi_naics_dict, cbg_prefixes=cbg_prefixes)
+
+
+def _aggregate_pattern_file_worker(input_pattern_file_path, pattern_columns):
+    """
+    This function aggregates one weekly patterns file in a process pool worker into a partial aggregate.
+    """
+    return Extract()._aggregate_pattern_file(input_pattern_file_path, pattern_columns, **_pattern_worker_args)
+
+
 # Example usage:
 # extractor = Extract()
 # extractor.POIs([...])
@@ -4,13 +4,17 @@
 
 ### IMPORT NECESSARY PACKAGES ###
 import pandas as pd
-import geopandas as gp
 import matplotlib.pyplot as plt
 import cartopy.crs as crs
 import cartopy.feature as cf
 from cartopy.mpl.gridliner import LONGITUDE_FORMATTER, LATITUDE_FORMATTER
+from SG_utility_tool import Extract
 
-def plot_map_of_visitor_count(CT_file, path_to_shapefile_CT, naics_name, county, save_file=False, save_directory=None):
+# map extent of the county of interest ([min LON, max LON, min LAT, max LAT]; adjust coordinates as needed)
+MAP_EXTENT = [-95.95, -94.9, 29.45, 30.2]
+
+def plot_map_of_visitor_count(CT_file, path_to_shapefile_CT, naics_name, county, save_file=False, save_directory=None,
+                              cache_filepath=None):
     """
     CT_file: path
             A path of type str locating the Census Tract csv file to use.
@@ -29,6 +33,9 @@ def plot_map_of_visitor_count(CT_file, path_to_shapefile_CT, naics_name, county,
 
     save_directory: path
             A path of type str where the plot should be saved. Required if save_file is True.
+
+    cache_filepath: path
+            A directory to store the geometry cache of the shapefile. Defaults to the directory of the shapefile.
     """
     file_ = pd.read_csv(CT_file)  # Read file with pandas
     
@@ -39,7 +46,9 @@ def plot_map_of_visitor_count(CT_file, path_to_shapefile_CT, naics_name, county,
     
     file_['TRACTCE'] = file_['TRACTCE'].astype(str)  # Convert series to type str
 
-    gdf = gp.read_file(path_to_shapefile_CT)
+    # only the tracts within the map extent are read, from the geometry cache of the shapefile
+    gdf = Extract().read_geometries(path_to_shapefile_CT, bbox=(MAP_EXTENT[0], MAP_EXTENT[2], MAP_EXTENT[1], MAP_EXTENT[3]),
+                                    cache_filepath=cache_filepath)
     gdf_ = gdf.merge(file_[['date_range_start', 'date_range_end', 'TRACTCE', 'Home_TRACTCE', 'Visitor_Count']], on='TRACTCE')
 
     # Plot the choropleth map
@@ -54,8 +63,8 @@ def plot_map_of_visitor_count(CT_file, path_to_shapefile_CT, naics_name, county,
     raw_visits_plot = gdf_.plot(column='Visitor_Count', cmap='jet', linewidth=1, ax=ax, edgecolor='0.8', vmin=0, vmax=20,
                                 cax=cax, legend=True, legend_kwds={'orientation': 'horizontal', 'label': 'Number'}, zorder=10)
     
-    # Set extent based on county location (adjust coordinates as needed)
-    ax.set_extent([-95.95, -94.9, 29.45, 30.2])
+    # Set extent based on county location
+    ax.set_extent(MAP_EXTENT)
     
     # Add grid lines
     #gl = ax.gridlines(draw_labels=True, alpha=0.6)